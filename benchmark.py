@@ -0,0 +1,257 @@
+import re
+import json
+import time
+import random
+import platform
+import tracemalloc
+import main
+import tools
+
+# Times the matching functions against the real lyrics and against generated corpora that are several times
+# bigger than songs.txt, so that a slower hot path shows up before it is deployed.
+# Results are printed and written as JSON.
+
+# The same comments and corpora are generated on every run
+seed = 0
+
+# Words for comments that have nothing to do with any song
+unrelated_words = [
+    "the", "game", "last", "night", "was", "honestly", "great", "i", "think", "you", "should", "watch", "it",
+    "again", "this", "thread", "is", "wild", "lol", "what", "does", "that", "even", "mean", "source", "please",
+    "anyone", "know", "where", "to", "buy", "tickets", "agreed", "100", "percent", "nope", "not", "at", "all"
+]
+
+# Comments that use the word regexes, which the hash matcher has to fold the same way as the regex matcher
+rule_examples = [
+    "Pressure like a drip, drip, drip that will never stop",
+    "Pressure like a drip, drip, drip that'll never stop",
+    "pressure that will tip, tip, tip 'til you just go pop",
+    "we dont talk about bruno no no no",
+    "wes dont talk about bruno",
+    "buts",
+    "that wa not a prophecy, i could just see u were sweating",
+    "he sayes that all my hair would disappear, now look at my head"
+]
+
+
+def build_corpus(real_song_dict, scale, rng):
+    # The real songs plus enough generated songs to make the corpus scale times as big.
+    # Generated lines use words of the real lyrics, with the same number of words per line and lines per song.
+    # The real songs get patterns of their own, so that the spans one scale compiles aren't already there for the next
+    song_dict = {song: dict(entry, patterns=main.compile_lyric_patterns(entry["clean_lyrics"]))
+                 for song, entry in real_song_dict.items()}
+    lines = [line for song in real_song_dict.values() for line in song["clean_lyrics"]]
+    vocabulary = sorted({word for line in lines for word in line.split(' ') if re.match(r'^[a-z0-9]+$', word)})
+    line_lengths = [len(line.split(' ')) for line in lines]
+    song_lengths = [len(song["clean_lyrics"]) for song in real_song_dict.values()]
+
+    for i in range((scale - 1) * len(real_song_dict)):
+        clean_lyrics = []
+        for j in range(rng.choice(song_lengths)):
+            clean_lyrics.append(" ".join(rng.choice(vocabulary) for k in range(rng.choice(line_lengths))))
+        song_dict["generated" + str(i)] = {
+            "original_lyrics": clean_lyrics,
+            "clean_lyrics": clean_lyrics,
+            "match_index": main.index_song_lyrics(clean_lyrics),
+            "ignore_indexes": [],
+            "continue_indexes": [],
+            "patterns": main.compile_lyric_patterns(clean_lyrics)
+        }
+
+    return song_dict, main.build_match_index(song_dict)
+
+
+def build_comments(real_song_dict, rng, call_count):
+    # Each comment is a real lyric line (sometimes two in a row), a near miss of one, or unrelated text.
+    # Returns (body, song, index) tuples, where index is the line the body is compared against.
+    comments = []
+    songs = list(real_song_dict)
+    for i in range(call_count):
+        song = rng.choice(songs)
+        original_lyrics = real_song_dict[song]["original_lyrics"]
+        index = rng.randrange(len(original_lyrics))
+        kind = i % 3
+        if kind == 0:
+            body = original_lyrics[index]
+            if index > 0 and rng.random() < 0.3:
+                body = original_lyrics[index - 1] + " " + body
+        elif kind == 1:
+            words = original_lyrics[index].split(' ')
+            if len(words) > 1 and rng.random() < 0.5:
+                del words[rng.randrange(len(words))]
+            else:
+                words[rng.randrange(len(words))] = rng.choice(unrelated_words)
+            body = " ".join(words)
+        else:
+            body = " ".join(rng.choice(unrelated_words) for j in range(rng.randint(3, 20)))
+        comments.append((body, song, index))
+    return comments
+
+
+def measure(function, calls):
+    # Run the calls once untimed so that lazily compiled patterns and caches are filled as they are in the bot,
+    # then time every call on its own, then run them again under tracemalloc for the peak memory
+    for call in calls:
+        function(*call)
+
+    latencies = []
+    start_time = time.perf_counter()
+    for call in calls:
+        call_start = time.perf_counter_ns()
+        function(*call)
+        latencies.append(time.perf_counter_ns() - call_start)
+    total_seconds = time.perf_counter() - start_time
+
+    tracemalloc.start()
+    for call in calls:
+        function(*call)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "calls": len(calls),
+        "seconds": total_seconds,
+        "calls_per_second": len(calls) / total_seconds if total_seconds > 0 else None,
+        "latency_ns": {
+            "p50": latencies[int(len(latencies) * 0.5)],
+            "p90": latencies[int(len(latencies) * 0.9)],
+            "p99": latencies[int(len(latencies) * 0.99)],
+            "max": latencies[-1]
+        },
+        "peak_memory_bytes": peak
+    }
+
+
+def run_benchmarks(song_dict, match_index, comments):
+    songs = main.get_songs()
+    clean_comments = [(main.clean_up_text(body), song, index) for body, song, index in comments]
+    reply_args = (main.help_link, main.reddit_tools.owner, main.reddit_tools.username, 2)
+
+    return {
+        "clean_up_text": measure(main.clean_up_text, [(body,) for body, song, index in comments]),
+        "close_match_count": measure(main.close_match_count, [
+            (song_dict[song]["patterns"], index, body) for body, song, index in clean_comments
+        ]),
+        "close_match": measure(main.close_match, [
+            (song_dict[song]["patterns"], index, body) for body, song, index in clean_comments
+        ]),
+        "get_potential_lyric_indexes": measure(main.get_potential_lyric_indexes, [
+            (song_dict, body, match_index) for body, song, index in clean_comments
+        ]),
+        "format_reply": measure(main.format_reply, [
+            (song_dict[song]["original_lyrics"][index], index, song, songs["dict"][song]) + reply_args +
+            (songs["urls"][song], main.optout_message_link, main.optin_message_link)
+            for body, song, index in comments
+        ]),
+        "smart_equals": measure(tools.smart_equals, [
+            (body, song_dict[song]["original_lyrics"][index]) for body, song, index in comments
+        ])
+    }
+
+
+def check_hash_agreement(song_dict, match_index, hash_index, texts):
+    # The texts where the hash matcher finds other lines than the regex matcher
+    result = []
+    for text in texts:
+        expected = [(index["song"], index["index"]) for index in main.get_potential_lyric_indexes(song_dict, text, match_index)]
+        found = [(index["song"], index["index"]) for index in main.get_hash_lyric_indexes(song_dict, hash_index, text)]
+        if found != expected:
+            result.append({"text": text, "regex": expected, "hash": found})
+    return result
+
+
+def run():
+    args = tools.get_args([
+        {
+            'name': 'scales',
+            'target_type': str,
+            'input_args': {
+                'invalid_message': 'Scales must be a comma separated list of positive integers.',
+                'cancel': 'default'
+            },
+            'condition': lambda x: re.match(r'^\d+(,\d+)*$', x) is not None and 0 not in [int(s) for s in x.split(',')],
+            'default': '1,10,100,1000'
+        },
+
+        {
+            'name': 'calls',
+            'target_type': int,
+            'input_args': {
+                'invalid_message': 'Calls must be a positive integer.',
+                'cancel': 'default'
+            },
+            'condition': lambda x: x > 0,
+            'default': 2000
+        },
+
+        {
+            'name': 'output file',
+            'target_type': str,
+            'input_args': {
+                'invalid_message': 'Output file cannot be empty.',
+                'cancel': 'default'
+            },
+            'condition': lambda x: x != '',
+            'default': 'benchmark.json'
+        }
+    ], False)
+
+    scales = [int(s) for s in (args['scales'] if args['scales'] != 'default' else '1,10,100,1000').split(',')]
+    call_count = args['calls'] if args['calls'] != 'default' else 2000
+    output_file = args['output file'] if args['output file'] != 'default' else 'benchmark.json'
+
+    print("Loading lyrics corpus")
+    corpus = main.load_corpus(main.get_songs()["list"], "hash")
+    real_song_dict = corpus["songs"]
+    comments = build_comments(real_song_dict, random.Random(seed), call_count)
+
+    disagreements = check_hash_agreement(real_song_dict, corpus["match_index"], corpus["hash_index"],
+                                         rule_examples + [body for body, song, index in comments])
+    print(f"The hash matcher disagrees with the regex matcher on {len(disagreements)} comments")
+    for disagreement in disagreements[:10]:
+        print(f"\t{disagreement}")
+
+    results = []
+    for scale in scales:
+        print(f"Building the {scale}x corpus")
+        start_time = time.perf_counter()
+        song_dict, match_index = build_corpus(real_song_dict, scale, random.Random(seed))
+        build_seconds = time.perf_counter() - start_time
+
+        # tracemalloc slows the build down, so the same corpus is built again to measure its memory
+        tracemalloc.start()
+        build_corpus(real_song_dict, scale, random.Random(seed))
+        build_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print(f"Running benchmarks on {len(song_dict)} songs")
+        benchmarks = run_benchmarks(song_dict, match_index, comments)
+        for name, benchmark in benchmarks.items():
+            print(f"\t{name}: {round(benchmark['calls_per_second'] or 0)} calls per second, "
+                  f"p50 {benchmark['latency_ns']['p50'] / 1000} us, p99 {benchmark['latency_ns']['p99'] / 1000} us, "
+                  f"peak memory {benchmark['peak_memory_bytes']} bytes")
+
+        results.append({
+            "scale": scale,
+            "songs": len(song_dict),
+            "lines": sum(len(song["clean_lyrics"]) for song in song_dict.values()),
+            "build_seconds": build_seconds,
+            "build_peak_memory_bytes": build_peak,
+            "benchmarks": benchmarks
+        })
+
+    report = {
+        "python": platform.python_version(),
+        "seed": seed,
+        "calls": call_count,
+        "hash_disagreements": disagreements,
+        "results": results
+    }
+    with open(output_file, 'w', encoding="utf-8") as f:
+        json.dump(report, f, indent=4)
+    print("Wrote results to " + output_file)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,223 @@
+import os
+import json
+import shutil
+import time
+import hashlib
+import threading
+import requests
+import comment_store
+
+# Recording and replaying of the HTTP traffic between praw and Reddit, so that a run can be repeated offline.
+# A cassette is a JSON file with every response of a recorded run, including its rate limit headers.
+# Set LYRICBOT_RECORD to a cassette file to record a run, or LYRICBOT_REPLAY to replay one.
+# When LYRICBOT_REPLAY_LATENCY is set, replayed responses take as long as they did when recorded.
+# What a run requests also depends on the local state it starts with, like the cursors and the replied under
+# records, so recording also saves a snapshot of that state next to the cassette (<cassette>.state).
+# A replay runs in a copy of the snapshot (<cassette>.replay), which is made fresh for every replay,
+# so it starts from the same state and never changes the real one. The times in the copy are moved forward
+# like the times of the responses, so that cursors and checkpoints cut the listings off at the same comments.
+
+cassette_version = 1
+
+# Fields of Reddit's JSON that hold a creation time. They are moved forward on replay by the time that has
+# passed since recording, so comments are as old as they were in the recorded run.
+time_fields = ('created_utc', 'created')
+
+# Fields that must never be written to a cassette
+secret_fields = ('access_token', 'refresh_token')
+
+# Files and directories, relative to the working directory, that a run reads or changes
+state_paths = (
+    'comment_state.db', 'daemon_checkpoint.json',
+    'user_blacklist.txt', 'user_blacklist.txt.journal',
+    'submission_ignore_list.txt', 'submission_ignore_list.txt.journal',
+    'songs.txt', 'subreddits.txt', 'word_regexes.txt', 'lyrics'
+)
+
+# The daemon's checkpoint, whose time is moved forward with the rest of the state
+checkpoint_file = 'daemon_checkpoint.json'
+
+# Files a replay needs that hold credentials. They are copied from the working directory for each replay,
+# but never saved with the cassette.
+config_paths = ('praw.ini',)
+
+
+def copy_paths(paths, source, destination):
+    for path in paths:
+        source_path = os.path.join(source, path)
+        destination_path = os.path.join(destination, path)
+        if os.path.isdir(source_path):
+            shutil.copytree(source_path, destination_path)
+        elif os.path.exists(source_path):
+            shutil.copy2(source_path, destination_path)
+
+
+def snapshot_state(directory):
+    # Save the local state as it is before the run changes it
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    copy_paths(state_paths, os.getcwd(), directory)
+
+
+def restore_state(snapshot, directory, offset):
+    # Make a fresh copy of the snapshot with its times moved forward by offset seconds, and run in it from now on
+    if not os.path.isdir(snapshot):
+        raise Exception('No state snapshot found for the cassette at ' + snapshot)
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    shutil.copytree(snapshot, directory)
+    copy_paths(config_paths, os.getcwd(), directory)
+    os.chdir(directory)
+
+    comment_store.shift_times(offset)
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file, 'r', encoding="utf-8") as f:
+            checkpoint = json.load(f)
+        # 0 means nothing has been handled yet
+        if checkpoint.get('created_utc'):
+            checkpoint['created_utc'] += offset
+        with open(checkpoint_file, 'w', encoding="utf-8") as f:
+            json.dump(checkpoint, f)
+
+
+def get_request_key(method, url, params=None, data=None):
+    # Requests match recorded ones by method, URL, query and form data.
+    # The form data of token requests holds the password, so it is left out.
+    parts = [method.upper(), url]
+    for values in (params, data):
+        if values is None or url.endswith('/access_token'):
+            parts.append('')
+        elif isinstance(values, dict):
+            parts.append(json.dumps(sorted([str(key), str(value)] for key, value in values.items())))
+        else:
+            parts.append(json.dumps(sorted([str(key), str(value)] for key, value in values)))
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def redact(body):
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return body
+    if isinstance(data, dict) and any(field in data for field in secret_fields):
+        for field in secret_fields:
+            if field in data:
+                data[field] = 'redacted'
+        return json.dumps(data)
+    return body
+
+
+def shift_times(data, offset):
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if key in time_fields and isinstance(value, (int, float)) and not isinstance(value, bool):
+                data[key] = value + offset
+            else:
+                shift_times(value, offset)
+    elif isinstance(data, list):
+        for value in data:
+            shift_times(value, offset)
+    return data
+
+
+class RecordingSession(requests.Session):
+    # Makes real requests and keeps every response to be saved as a cassette
+    def __init__(self, file_name):
+        super().__init__()
+        self.file_name = os.path.abspath(file_name)
+        snapshot_state(self.file_name + '.state')
+        self.recorded_utc = time.time()
+        self.interactions = []
+        self.lock = threading.Lock()
+
+    def request(self, method, url, params=None, data=None, **kwargs):
+        start_time = time.time()
+        response = super().request(method, url, params=params, data=data, **kwargs)
+        interaction = {
+            'key': get_request_key(method, url, params, data),
+            'method': method.upper(),
+            'url': url,
+            'status': response.status_code,
+            'headers': dict(response.headers),
+            'body': redact(response.text),
+            'elapsed': time.time() - start_time
+        }
+        with self.lock:
+            self.interactions.append(interaction)
+        return response
+
+    def save(self):
+        with self.lock:
+            cassette = {
+                'version': cassette_version,
+                'recorded_utc': self.recorded_utc,
+                'interactions': self.interactions
+            }
+            with open(self.file_name + '.tmp', 'w', encoding="utf-8") as f:
+                json.dump(cassette, f)
+            os.replace(self.file_name + '.tmp', self.file_name)
+
+    def close(self):
+        self.save()
+        super().close()
+
+
+class ReplaySession(requests.Session):
+    # Answers every request with the next recorded response for the same request, without touching the network
+    def __init__(self, file_name, latency=False):
+        super().__init__()
+        with open(file_name, 'r', encoding="utf-8") as f:
+            cassette = json.load(f)
+        if cassette.get('version') != cassette_version:
+            raise Exception('Unsupported cassette version: ' + str(cassette.get('version')))
+
+        self.latency = latency
+        self.offset = time.time() - cassette['recorded_utc']
+        self.lock = threading.Lock()
+        # Recorded responses of each request, in the order they were made
+        self.interactions = {}
+        for interaction in cassette['interactions']:
+            self.interactions.setdefault(interaction['key'], []).append(interaction)
+
+    def request(self, method, url, params=None, data=None, **kwargs):
+        key = get_request_key(method, url, params, data)
+        with self.lock:
+            interactions = self.interactions.get(key)
+            if interactions is None:
+                raise Exception(f'No recorded response for {method.upper()} {url} {params}')
+            # Making a request more often than the recorded run did means the replay has diverged from it
+            if len(interactions) == 0:
+                raise Exception(f'Every recorded response for {method.upper()} {url} {params} has been used')
+            interaction = interactions.pop(0)
+
+        if self.latency:
+            time.sleep(interaction['elapsed'])
+
+        body = interaction['body']
+        if body.startswith('{') or body.startswith('['):
+            body = json.dumps(shift_times(json.loads(body), self.offset))
+
+        response = requests.Response()
+        response.status_code = interaction['status']
+        response.headers = requests.structures.CaseInsensitiveDict(interaction['headers'])
+        # The body is stored decoded, so it can't still be compressed
+        response.headers.pop('content-encoding', None)
+        response.headers.pop('content-length', None)
+        response._content = body.encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = url
+        response.request = requests.Request(method, url, params=params).prepare()
+        return response
+
+
+def get_session():
+    # The session given by the environment, or None to make real requests without recording them
+    if os.environ.get('LYRICBOT_REPLAY'):
+        file_name = os.path.abspath(os.environ['LYRICBOT_REPLAY'])
+        session = ReplaySession(file_name, latency=bool(os.environ.get('LYRICBOT_REPLAY_LATENCY')))
+        restore_state(file_name + '.state', file_name + '.replay', session.offset)
+        return session
+    if os.environ.get('LYRICBOT_RECORD'):
+        return RecordingSession(os.environ['LYRICBOT_RECORD'])
+    return None
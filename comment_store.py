@@ -0,0 +1,162 @@
+import sqlite3
+import threading
+import time
+
+# Local record of the comments this bot has already evaluated, so that we don't have to ask Reddit again.
+# replied_under is 1 if the bot has replied somewhere under the comment and 0 if it hadn't when evaluated.
+# cursors holds the creation time of the newest comment of each subreddit that a finished scan has seen.
+# negative_matches holds hashes of comment texts that matched no lyric, with when each was last used.
+# bot_replies holds the chain state this bot wrote into each of its replies, by reply ID and parent fullname.
+# song and position are NULL for replies that aren't part of a chain.
+database_file = 'comment_state.db'
+
+# Each thread gets its own connection, as sqlite connections can't be shared between threads
+connections = threading.local()
+
+
+def get_connection():
+    connection = getattr(connections, 'connection', None)
+    if connection is None:
+        connection = sqlite3.connect(database_file, timeout=30)
+        connections.connection = connection
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS comments ("
+            "id TEXT PRIMARY KEY, "
+            "replied_under INTEGER NOT NULL, "
+            "evaluated_utc REAL NOT NULL)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS cursors ("
+            "name TEXT PRIMARY KEY, "
+            "created_utc REAL NOT NULL)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS negative_matches ("
+            "hash TEXT PRIMARY KEY, "
+            "used_utc REAL NOT NULL)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS bot_replies ("
+            "id TEXT PRIMARY KEY, "
+            "parent_id TEXT NOT NULL, "
+            "song TEXT, "
+            "position INTEGER, "
+            "compatibility_mode INTEGER NOT NULL, "
+            "created_utc REAL NOT NULL)"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS bot_replies_parent_id ON bot_replies (parent_id)")
+        connection.commit()
+    return connection
+
+
+def get_replied_under(comment_id):
+    # Returns True or False if the comment has been evaluated before, None if it hasn't
+    row = get_connection().execute(
+        "SELECT replied_under FROM comments WHERE id = ?", (comment_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    return row[0] == 1
+
+
+def set_replied_under(comment_id, replied_under):
+    set_replied_under_many([(comment_id, replied_under)])
+
+
+def set_replied_under_many(results):
+    # results are (comment_id, replied_under) pairs, saved in one transaction
+    connection = get_connection()
+    now = time.time()
+    connection.executemany(
+        "INSERT OR REPLACE INTO comments (id, replied_under, evaluated_utc) VALUES (?, ?, ?)",
+        [(comment_id, 1 if replied_under else 0, now) for comment_id, replied_under in results]
+    )
+    connection.commit()
+
+
+def get_cursor(name):
+    # Returns the creation time of the newest comment a finished scan of the subreddit saw, None if there wasn't one
+    row = get_connection().execute(
+        "SELECT created_utc FROM cursors WHERE name = ?", (name.lower(),)
+    ).fetchone()
+    if row is None:
+        return None
+    return row[0]
+
+
+def set_cursor(name, created_utc):
+    connection = get_connection()
+    connection.execute(
+        "INSERT OR REPLACE INTO cursors (name, created_utc) VALUES (?, ?)",
+        (name.lower(), created_utc)
+    )
+    connection.commit()
+
+
+def get_negative_matches():
+    return {row[0] for row in get_connection().execute("SELECT hash FROM negative_matches")}
+
+
+def save_negative_matches(hashes, max_count):
+    # Mark the hashes as used now, in one transaction, then forget all but the max_count most recently used
+    connection = get_connection()
+    now = time.time()
+    connection.executemany(
+        "INSERT OR REPLACE INTO negative_matches (hash, used_utc) VALUES (?, ?)",
+        [(text_hash, now) for text_hash in hashes]
+    )
+    connection.execute(
+        "DELETE FROM negative_matches WHERE hash NOT IN "
+        "(SELECT hash FROM negative_matches ORDER BY used_utc DESC LIMIT ?)", (max_count,)
+    )
+    connection.commit()
+
+
+def get_bot_reply(comment_id):
+    # Returns (parent_id, song, position, compatibility_mode) if the comment is a known reply of this bot, None if not
+    return get_connection().execute(
+        "SELECT parent_id, song, position, compatibility_mode FROM bot_replies WHERE id = ?", (comment_id,)
+    ).fetchone()
+
+
+def has_bot_reply_under(parent_id):
+    row = get_connection().execute(
+        "SELECT 1 FROM bot_replies WHERE parent_id = ? LIMIT 1", (parent_id,)
+    ).fetchone()
+    return row is not None
+
+
+def save_bot_replies(replies):
+    # replies are (id, parent_id, song, position, compatibility_mode, created_utc) tuples
+    connection = get_connection()
+    connection.executemany(
+        "INSERT OR REPLACE INTO bot_replies (id, parent_id, song, position, compatibility_mode, created_utc) "
+        "VALUES (?, ?, ?, ?, ?, ?)", replies
+    )
+    connection.commit()
+
+
+def shift_times(offset):
+    # Move every stored time forward by offset seconds, for a replay whose comments are that much newer
+    connection = get_connection()
+    connection.execute("UPDATE comments SET evaluated_utc = evaluated_utc + ?", (offset,))
+    connection.execute("UPDATE cursors SET created_utc = created_utc + ?", (offset,))
+    connection.execute("UPDATE negative_matches SET used_utc = used_utc + ?", (offset,))
+    connection.execute("UPDATE bot_replies SET created_utc = created_utc + ?", (offset,))
+    connection.commit()
+
+
+def prune(max_age_seconds):
+    # Forget comments evaluated too long ago to show up in a scan again.
+    # Forgotten comments are simply evaluated again if they do show up.
+    connection = get_connection()
+    connection.execute("DELETE FROM comments WHERE evaluated_utc < ?", (time.time() - max_age_seconds,))
+    connection.commit()
+
+
+def close():
+    # Close the connection of the current thread
+    connection = getattr(connections, 'connection', None)
+    if connection is not None:
+        connection.close()
+        connections.connection = None
@@ -0,0 +1,190 @@
+import os
+import json
+import math
+import time
+import signal
+import traceback
+import main
+import reddit_tools
+import comment_store
+import metrics
+
+# Runs the bot continuously, following new comments in every subreddit as they are made,
+# instead of being launched again and again by launcher.py.
+
+compatibility_mode = 2
+# Comments older than this are never handled, even right after starting with no checkpoint
+max_age_hours = 2
+# How often to check the inbox, save the checkpoint and clear the caches
+maintenance_interval = 5 * 60
+# How long to wait before following the stream again after an error
+error_wait_time = 30
+
+# How long to wait between polls of the listing. The wait doubles after every poll that found nothing new,
+# up to the maximum, and goes back to the minimum once a new comment arrives.
+min_poll_wait_time = 2
+max_poll_wait_time = 60
+
+# How comments are matched to lyric lines: "regex", "hash" or "shadow" (see main.setup)
+match_mode = "regex"
+
+checkpoint_file = 'daemon_checkpoint.json'
+
+stopping = False
+
+def request_stop(signum, frame):
+	global stopping
+	if not stopping:
+		print("")
+		print("Stopping after the current comment...")
+	stopping = True
+
+def get_subreddits():
+	#Determine if the file "subreddits.txt" exists. Make it if not.
+	if not os.path.exists('subreddits.txt'):
+		with open('subreddits.txt', 'w', encoding="utf-8") as f:
+			pass
+
+	result = []
+
+	for line in main.get_file_contents('subreddits.txt'):
+		if line != "" and not line.startswith('#'):
+			result.append(reddit_tools.test_subreddit if line == 'default' else line)
+
+	return result
+
+def read_checkpoint():
+	# The newest comment handled before the last shutdown, so that it isn't handled again after a restart.
+	# ids holds every handled comment made in that same second.
+	if not os.path.exists(checkpoint_file):
+		return {"created_utc": 0, "ids": []}
+	with open(checkpoint_file, 'r', encoding="utf-8") as f:
+		return json.load(f)
+
+def write_checkpoint(checkpoint):
+	with open(checkpoint_file + ".tmp", 'w', encoding="utf-8") as f:
+		json.dump(checkpoint, f)
+	os.replace(checkpoint_file + ".tmp", checkpoint_file)
+
+def update_checkpoint(checkpoint, comment):
+	if comment.created_utc > checkpoint["created_utc"]:
+		checkpoint["created_utc"] = comment.created_utc
+		checkpoint["ids"] = [comment.id]
+	elif comment.created_utc == checkpoint["created_utc"] and comment.id not in checkpoint["ids"]:
+		checkpoint["ids"].append(comment.id)
+
+def is_new(checkpoint, comment):
+	if (time.time() - comment.created_utc) / 3600 > max_age_hours:
+		return False
+	if comment.created_utc < checkpoint["created_utc"]:
+		return False
+	return comment.id not in checkpoint["ids"]
+
+def wait(seconds):
+	# Sleep in short slices so that a request to stop is noticed within a second
+	end_time = time.time() + seconds
+	while not stopping and time.time() < end_time:
+		time.sleep(min(1, end_time - time.time()))
+
+def wait_for_reset():
+	# Sleep until the rate limit resets, when there is quota for scanning again
+	reset_timestamp = reddit_tools.get_limits()['reset_timestamp']
+	wait_time = max(reset_timestamp - time.time(), 1) if reset_timestamp is not None else error_wait_time
+	print("Waiting " + str(round(wait_time)) + " seconds for the rate limit to reset...")
+	wait(wait_time)
+
+def do_maintenance(context, checkpoint):
+	write_checkpoint(checkpoint)
+
+	print("checking for user blacklist additions and submissions to ignore")
+	with metrics.stage("inbox"):
+		main.process_inbox(context["user_blacklist"], context["submission_ignore_list"])
+
+	# The caches only help while a chain is active, so they don't need to grow forever
+	main.save_negative_matches()
+	main.clear_run_caches()
+	comment_store.prune(7 * 24 * 60 * 60)
+
+def run():
+	subreddits = get_subreddits()
+	if len(subreddits) == 0:
+		print("No subreddits to follow. Add some to subreddits.txt.")
+		return
+
+	# Everything the daemon records, written to metrics/daemon.json and metrics/daemon.prom every few minutes
+	daemon_metrics = metrics.start_run('daemon')
+
+	# Load the lyrics once. There is no process start time, every comment is handled as it arrives.
+	context = main.setup(math.inf, match_mode)
+	checkpoint = read_checkpoint()
+
+	handled_comments = 0
+	replied_comments = 0
+	filter_stats = main.new_filter_stats()
+	daemon_metrics.filters = filter_stats
+	last_maintenance = time.time()
+	poll_wait_time = min_poll_wait_time
+	found_new = False
+
+	print("Following comments in " + ", ".join(subreddits))
+	while not stopping:
+		try:
+			for comment in reddit_tools.stream_combined_comments(subreddits):
+				if stopping:
+					break
+
+				if comment is None:
+					# The stream yields None after every poll of the listing, so wait before the next one
+					poll_wait_time = min_poll_wait_time if found_new else min(poll_wait_time * 2, max_poll_wait_time)
+					found_new = False
+					wait(poll_wait_time)
+				elif is_new(checkpoint, comment):
+					found_new = True
+					# A comment that fails is not tried again, otherwise it would stop the stream every time
+					try:
+						try:
+							result = main.handle_comment(context, comment, compatibility_mode, filter_stats)
+						except reddit_tools.BudgetExhausted as e:
+							# Try the comment again once there is quota for it
+							print(f"Out of requests: {e}")
+							wait_for_reset()
+							result = main.handle_comment(context, comment, compatibility_mode, filter_stats)
+						daemon_metrics.count_outcome(result if result is not None else "skipped")
+						if result is not None:
+							handled_comments += 1
+						if result == "replied":
+							replied_comments += 1
+					except Exception as e:
+						print("")
+						print(f"Error handling comment '{comment.id}'")
+						print(traceback.format_exc())
+					update_checkpoint(checkpoint, comment)
+
+				if time.time() - last_maintenance > maintenance_interval:
+					do_maintenance(context, checkpoint)
+					last_maintenance = time.time()
+					print(f"Handled {handled_comments} comments and replied to {replied_comments} so far.")
+					main.print_filter_stats(filter_stats)
+					daemon_metrics.write()
+		except reddit_tools.BudgetExhausted as e:
+			print(f"Out of requests: {e}")
+			if not stopping:
+				wait_for_reset()
+		except Exception as e:
+			print("")
+			print("Error following comments")
+			print(traceback.format_exc())
+			if not stopping:
+				print("Following again in " + str(error_wait_time) + " seconds...")
+				wait(error_wait_time)
+
+	write_checkpoint(checkpoint)
+	daemon_metrics.write()
+	comment_store.close()
+	print(f"Stopped. Handled {handled_comments} comments and replied to {replied_comments}.")
+
+if __name__ == "__main__":
+	signal.signal(signal.SIGINT, request_stop)
+	signal.signal(signal.SIGTERM, request_stop)
+	print("Starting daemon on " + time.strftime("%Y-%m-%d %H:%M:%S") + "...")
+	run()
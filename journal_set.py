@@ -0,0 +1,77 @@
+import os
+
+# A set of strings kept in memory and saved as a snapshot file, with one line per item,
+# and a journal file that every add and remove is appended to ("+item" or "-item").
+# Loading replays the journal over the snapshot. Once the journal gets long it is folded into the snapshot.
+
+
+class JournalSet:
+    def __init__(self, file_name, compact_after=1000):
+        self.file_name = file_name
+        self.journal_file_name = file_name + '.journal'
+        self.compact_after = compact_after
+        self.items = set()
+        self.journal_length = 0
+
+        if os.path.exists(self.file_name):
+            with open(self.file_name, 'r', encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line != "" and not line.startswith('#'):
+                        self.items.add(line)
+        else:
+            # Write an empty snapshot to the file
+            with open(self.file_name, 'w', encoding="utf-8"):
+                pass
+
+        if os.path.exists(self.journal_file_name):
+            with open(self.journal_file_name, 'r', encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if line.startswith('+'):
+                        self.items.add(line[1:])
+                    elif line.startswith('-'):
+                        self.items.discard(line[1:])
+                    else:
+                        continue
+                    self.journal_length += 1
+
+        if self.journal_length > self.compact_after:
+            self.compact()
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        if item not in self.items:
+            self.items.add(item)
+            self.write_journal('+' + item)
+
+    def remove(self, item):
+        if item in self.items:
+            self.items.remove(item)
+            self.write_journal('-' + item)
+
+    def write_journal(self, record):
+        with open(self.journal_file_name, 'a', encoding="utf-8") as f:
+            f.write(record + '\n')
+        self.journal_length += 1
+        if self.journal_length > self.compact_after:
+            self.compact()
+
+    def compact(self):
+        # Write every item to the snapshot and empty the journal.
+        # Replaying the journal over the new snapshot gives the same items, so stopping in between is safe.
+        with open(self.file_name + '.tmp', 'w', encoding="utf-8") as f:
+            for item in sorted(self.items):
+                f.write(item + '\n')
+        os.replace(self.file_name + '.tmp', self.file_name)
+        with open(self.journal_file_name, 'w', encoding="utf-8"):
+            pass
+        self.journal_length = 0
@@ -1,9 +1,15 @@
 import os
+import io
 import sys
 import time
 import main
 import traceback
 import tools
+import threading
+import reddit_tools
+import comment_store
+import metrics
+from concurrent.futures import ThreadPoolExecutor
 
 args = tools.get_args([
 	{
@@ -81,17 +87,52 @@ subreddits = get_subreddits()
 comment_limit = 500
 max_age_hours = 2
 compatibility_mode = 2
+prefetch_threads = True
+# Fetch the comments of every subreddit through one combined listing instead of one listing each
+combined_fetch = True
+
+# Requests each subreddit may use before it stops scanning. Replies are still made after that. 0 means no budget.
+request_budget = 200
+
+# How comments are matched to lyric lines: "regex", "hash" or "shadow" (see main.setup)
+match_mode = "regex"
+
+# Number of subreddits to run at the same time. They all share one rate limit budget.
+worker_count = 4
 
 launch_count = 0
 launch_tries = 0
 
-for subreddit in subreddits:
+class ThreadOutput:
+	# Sends everything a worker thread prints to its own buffer so that the output of
+	# subreddits running at the same time doesn't get mixed together
+	def __init__(self, stream):
+		self.stream = stream
+		self.buffers = threading.local()
+
+	def write(self, text):
+		buffer = getattr(self.buffers, 'buffer', None)
+		if buffer is None:
+			return self.stream.write(text)
+		return buffer.write(text)
+
+	def flush(self):
+		self.stream.flush()
+
+def launch(subreddit, context, comments=None):
+	# Run the bot in one subreddit. Returns whether it succeeded, everything it printed and the metrics of the run.
+	output.buffers.buffer = io.StringIO()
+	# Worker threads are reused, so don't let this run add to the metrics of the previous one
+	metrics.start_run(subreddit)
 	args = {
 		"subreddit": subreddit,
 		"comment limit": comment_limit,
 		"max age (hours)": max_age_hours,
 		"compatibility mode": compatibility_mode,
-		"use progress bar": use_progress_bar
+		# Progress bars of different subreddits would draw over each other
+		"use progress bar": use_progress_bar and worker_count == 1,
+		"prefetch threads": prefetch_threads,
+		"request budget": request_budget
 	}
 
 	command = f"{sys.executable} \"{path}/main.py\" {subreddit} {comment_limit} {max_age_hours} {compatibility_mode}"
@@ -99,21 +140,86 @@ for subreddit in subreddits:
 	print("Launching in '" + subreddit + "' subreddit")
 	print("Command to execute: " + command)
 	print("")
+	success = False
 	try:
-		main.main(args)
-		launch_count += 1
+		main.main(args, context, comments)
+		success = True
 	except Exception as e:
 		print("")
 		print("Error running bot")
 		print(traceback.format_exc())
-	
-	launch_tries += 1
+
+	text = output.buffers.buffer.getvalue()
+	output.buffers.buffer = None
+	return success, text, metrics.get_current()
+
+output = ThreadOutput(sys.stdout)
+sys.stdout = output
+
+# Everything recorded in this thread, plus the metrics of every subreddit once it is done.
+# Written to metrics/launcher.json and metrics/launcher.prom at the end.
+launcher_metrics = metrics.start_run('launcher')
+
+def run_launches():
+	global launch_count, launch_tries
+	# Load the lyrics and process the inbox once for all subreddits.
+	# If that fails, every subreddit counts as a failed launch, as each used to set itself up.
+	try:
+		context = main.setup(match_mode=match_mode)
+	except Exception:
+		print("")
+		print("Error setting up the bot")
+		print(traceback.format_exc())
+		launch_tries += len(subreddits)
+		return
+
+	comments_by_subreddit = {}
+	if combined_fetch and len(subreddits) > 0:
+		names = [reddit_tools.test_subreddit if subreddit == 'default' else subreddit for subreddit in subreddits]
+		print("Getting comments for all subreddits")
+		start_time = time.time()
+		# Paging can stop once every subreddit is past the newest comment its last scan saw
+		cursors = [comment_store.get_cursor(name) for name in names]
+		after_utc = None if None in cursors else min(cursors)
+		try:
+			with metrics.stage("combined fetch"):
+				combined_comments = reddit_tools.get_combined_comments(names, comment_limit, max_age_hours, after_utc)
+			for i in range(len(subreddits)):
+				comments_by_subreddit[subreddits[i]] = combined_comments[names[i].lower()]
+			print(f"Got {sum(len(comments) for comments in combined_comments.values())} comments in {str(time.time() - start_time)} seconds")
+		except reddit_tools.BudgetExhausted as e:
+			# Each subreddit fetches its own comments instead, and stops early itself if there is still no quota
+			print(f"Not fetching the combined listing: {e}")
+		except Exception:
+			print("")
+			print("Error getting the combined listing. Each subreddit will get its own comments.")
+			print(traceback.format_exc())
+
+	with ThreadPoolExecutor(max_workers=worker_count) as executor:
+		futures = [executor.submit(launch, subreddit, context, comments_by_subreddit.get(subreddit)) for subreddit in subreddits]
+		# Print the output of each subreddit in order as a single block.
+		# A failed run still returns what it recorded, so it is merged like any other.
+		for future in futures:
+			success, text, run_metrics = future.result()
+			print(text, end="")
+			launcher_metrics.merge(run_metrics)
+			if success:
+				launch_count += 1
+			launch_tries += 1
+
+# However the launches end, the metrics are written and start_time.txt is removed
+try:
+	run_launches()
+finally:
+	sys.stdout = output.stream
+	launcher_metrics.write()
+	#delete the start_time.txt file
+	os.remove('start_time.txt')
 
 print("")
 
-print("Successfully launched the bot " + str(launch_count) + " times out of " + str(launch_tries) + " tries (" + str(round(launch_count / launch_tries * 100, 2)) + "% success rate).")
-#delete the start_time.txt file
-os.remove('start_time.txt')
+if launch_tries > 0:
+	print("Successfully launched the bot " + str(launch_count) + " times out of " + str(launch_tries) + " tries (" + str(round(launch_count / launch_tries * 100, 2)) + "% success rate).")
 
 #wait for the specified amount of time before ending the program
 if wait_time > 0:
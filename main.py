@@ -1,4 +1,7 @@
 import reddit_tools
+import comment_store
+import journal_set
+import metrics
 import os
 import sys
 import tools
@@ -6,6 +9,12 @@ import re
 import time
 import math
 import traceback
+import hashlib
+import pickle
+try:
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
 try:
 	from tqdm import tqdm
 except:
@@ -25,31 +34,139 @@ def get_file_contents(file_name):
     return result
 
 
+class CleanText(str):
+    # Text that has already been through clean_up_text without word regexes.
+    # Cleaning is idempotent, so passing one of these to clean_up_text again returns it unchanged.
+    pass
+
+
+# Clean comment bodies by the original body, so the same text posted by several users is only cleaned once.
+# Cleared at the start of every run.
+clean_body_cache = {}
+
+# Potential lyric indexes by clean text, so the lyric match runs once per distinct text in a run
+lyric_match_cache = {}
+
+# Hashes of clean texts that match no lyric with the current corpus (see get_text_hash).
+# Loaded from the comment store in setup(). The hashes used in a run are saved back by save_negative_matches().
+negative_matches = set()
+used_negative_matches = set()
+# Most texts kept in the comment store. The ones used least recently are forgotten first.
+negative_match_limit = 100000
+
+
+# Character cleanup applied by str.translate once accents have been stripped.
+# Letters and numbers are lowercased, apostrophes are removed and everything else becomes a space.
+class CleanupTable(dict):
+    def __missing__(self, key):
+        return ' '
+
+
+cleanup_table = CleanupTable()
+for code in range(128):
+    char = chr(code)
+    if char.isalnum():
+        cleanup_table[code] = char.lower()
+cleanup_table[ord("'")] = None
+cleanup_table[ord('’')] = None
+
+# Matches a character repeated more than once
+repeat_pattern = re.compile(r'([a-zA-Z\d])\1+')
+
+
+class Normalizer:
+    # Cleans up text in one pass, using tables built once from the word regexes.
+    # All of the word regexes are folded into a single alternation. When a word matches one of them,
+    # the word regexes after it are applied to the replacement, which gives the same result as
+    # substituting each word regex over the whole text in order.
+
+    def __init__(self, word_regexes=None):
+        flags = re.IGNORECASE | re.MULTILINE
+        self.rules = []
+        self.dispatch = {}
+        alternatives = []
+        if word_regexes:
+            for word in word_regexes:
+                name = "rule" + str(len(self.rules))
+                self.dispatch[name] = len(self.rules)
+                self.rules.append((re.compile(f"(\\W|^)({word})(?=\\W|$)", flags), f"\\1{word_regexes[word]}"))
+                alternatives.append(f"(?P<{name}>{word})")
+
+        if alternatives:
+            self.word_pattern = re.compile("(\\W|^)(?:" + "|".join(alternatives) + ")(?=\\W|$)", flags)
+        else:
+            self.word_pattern = None
+
+    def replace_word(self, match):
+        # The named group of the rule that matched is the last group to close
+        rule = self.dispatch[match.lastgroup]
+        pattern, template = self.rules[rule]
+        result = pattern.match(match.string, match.start()).expand(template)
+        for pattern, template in self.rules[rule + 1:]:
+            result = pattern.sub(template, result)
+        return result
+
+    def normalize(self, text):
+        if isinstance(text, CleanText) and self.word_pattern is None:
+            return text
+
+        # Strip accents
+        text = tools.strip_accents(text)
+        # Clean up the characters, then replace all whitespace with a single space and strip the ends
+        text = " ".join(text.translate(cleanup_table).split())
+        if self.word_pattern is not None:
+            # substitute whole words with their regex equivalent
+            text = self.word_pattern.sub(self.replace_word, text)
+        # Replace a character repeated more than once with a single instance
+        text = repeat_pattern.sub(r'\1', text)
+
+        if self.word_pattern is None:
+            return CleanText(text)
+        return text
+
+
+plain_normalizer = Normalizer()
+
+
 def clean_up_text(text, word_regexes=None):
-    # Strip accents
-    text = tools.strip_accents(text)
-
-    # Remove all non-alphanumeric characters (except - and ') by replacing with space
-    text = re.sub(r'[^a-zA-Z0-9\-\'’]', ' ', text)
-    # Replace ' with nothing
-    text = re.sub(r'[\'’]', '', text)
-    # Replace one or more dashes with a single space
-    text = re.sub(r'-+', ' ', text)
-    # Replace all whitespace with a single space
-    text = re.sub(r'\s+', ' ', text)
-    # Strip leading and trailing spaces
-    text = text.strip()
-    # Convert to lowercase
-    text = text.lower()
-    if word_regexes:
-        # substitute whole words with their regex equivalent
-        for word in word_regexes:
-            text = re.sub(f"(\\W|^)({word})(?=\\W|$)", f"\\1{word_regexes[word]}", text,
-                          flags=re.IGNORECASE | re.MULTILINE)
-    # Replace a character repeated more than once with a single instance
-    text = re.sub(r'([a-zA-Z\d])\1+', r'\1', text)
-
-    return text
+    # word_regexes can either be a Normalizer or a dictionary from get_word_regexes
+    if isinstance(word_regexes, Normalizer):
+        normalizer = word_regexes
+    elif word_regexes:
+        normalizer = Normalizer(word_regexes)
+    else:
+        normalizer = plain_normalizer
+    return normalizer.normalize(text)
+
+
+def get_clean_body(comment):
+    # Clean the body of a comment, reusing the result if the same text was already cleaned in this run
+    body = comment.body
+    if body not in clean_body_cache:
+        clean_body_cache[body] = clean_up_text(body)
+    return clean_body_cache[body]
+
+
+def clear_run_caches():
+    clean_body_cache.clear()
+    lyric_match_cache.clear()
+    reddit_tools.clear_caches()
+
+
+def get_text_hash(context, clean_text):
+    # The corpus key is part of the hash, so a text is matched again whenever the lyrics or word regexes change
+    return hashlib.sha256((context["corpus_key"] + "\n" + clean_text).encode("utf-8")).hexdigest()
+
+
+def save_negative_matches():
+    # Save the texts that matched nothing and were used in this run, forgetting the least recently used ones
+    hashes = list(used_negative_matches)
+    used_negative_matches.difference_update(hashes)
+    comment_store.save_negative_matches(hashes, negative_match_limit)
+    if len(negative_matches) > negative_match_limit:
+        # Only keep what is left in the store, as a long running process would otherwise keep growing
+        negative_matches.clear()
+        negative_matches.update(comment_store.get_negative_matches())
 
 
 def get_original_lyrics(song):
@@ -70,39 +187,24 @@ def get_original_lyrics(song):
         )
 
 
-def get_clean_lyrics(song, word_regexes):
+def generate_clean_lyrics(song, lyrics, normalizer):
     # Determine if the directory lyrics/clean exists. Make it if not.
     if not os.path.exists('lyrics/clean'):
         os.makedirs('lyrics/clean')
 
-    # Get the file name
-    file_name = 'lyrics/clean/' + song + '.txt'
-    # Get the file name of the original lyrics
-    original_file_name = 'lyrics/original/' + song + '.txt'
-
-    # If the file already exists, return the contents
-    if os.path.exists(file_name):
-        return get_file_contents(file_name)
-    elif os.path.exists(original_file_name):
-        # get the file contents of the original lyrics and clean each line individually
-        lyrics = get_original_lyrics(song)
-        print("Generating clean lyrics for '" + song + "'")
-        clean_lyrics = []
-        for line in lyrics:
-            line = line.strip()
-            if not line.startswith('#'):
-                clean_lyrics.append(clean_up_text(line, word_regexes))
+    # clean each line of the original lyrics individually
+    print("Generating clean lyrics for '" + song + "'")
+    clean_lyrics = []
+    for line in lyrics:
+        line = line.strip()
+        if not line.startswith('#'):
+            clean_lyrics.append(normalizer.normalize(line))
 
-        # Write the cleaned lyrics to the file
-        with open(file_name, 'w', encoding="utf-8") as f:
-            for line in clean_lyrics:
-                f.write(line + '\n')
-        return clean_lyrics
-    else:
-        raise Exception(
-            'No lyrics found for "' + song +
-            '". Please add them through a text file in the lyrics/original directory. The file name should be the same as the song name.'
-        )
+    # Write the cleaned lyrics to the file, replacing any previous version
+    with open('lyrics/clean/' + song + '.txt', 'w', encoding="utf-8") as f:
+        for line in clean_lyrics:
+            f.write(line + '\n')
+    return clean_lyrics
 
 
 def get_word_regexes():
@@ -123,48 +225,13 @@ def get_word_regexes():
     return result
 
 
-def get_compatibility_mode(comment):
-    compatibility_mode = re.search(r'Compatibility mode: (\d+)', comment.body)
-    if compatibility_mode is None:
-        return 1
-    else:
-        return int(compatibility_mode.group(1))
-
-
 def get_user_blacklist():
-    user_blacklist = []
-    if os.path.exists('user_blacklist.txt'):
-        user_blacklist = get_file_contents('user_blacklist.txt')
-    else:
-        # Write an empty blacklist to the file
-        with open('user_blacklist.txt', 'w', encoding="utf-8"):
-            pass
-    return user_blacklist
+    # Users that opted out. Opt-outs and opt-ins are saved as they happen.
+    return journal_set.JournalSet('user_blacklist.txt')
 
 
 def get_submission_ignore_list():
-    submission_ignore_list = []
-    if os.path.exists('submission_ignore_list.txt'):
-        submission_ignore_list = get_file_contents('submission_ignore_list.txt')
-    else:
-        # Write an empty blacklist to the file
-        with open('submission_ignore_list.txt', 'w', encoding="utf-8") as f:
-            pass
-    return submission_ignore_list
-
-
-def update_user_blacklist(user_blacklist):
-    # overwrite the user blacklist with the new one
-    with open('user_blacklist.txt', 'w', encoding="utf-8") as f:
-        for user in user_blacklist:
-            f.write(user + '\n')
-
-
-def update_submission_ignore_list(submission_ignore_list):
-    # overwrite the submission ignore list with the new one
-    with open('submission_ignore_list.txt', 'w', encoding="utf-8") as f:
-        for submission in submission_ignore_list:
-            f.write(submission + '\n')
+    return journal_set.JournalSet('submission_ignore_list.txt')
 
 
 def strip_lines(string):
@@ -215,74 +282,540 @@ def count_matching_letters(word1, word2):
     return count
 
 
-def close_match_count(lyrics, index, text):
+def get_max_width(pattern):
+    # The most characters the regex can match, or None if there is no limit
+    width = sre_parse.parse(pattern).getwidth()[1]
+    if width >= sre_parse.MAXREPEAT - 1:
+        return None
+    return width
+
+
+def compile_lyric_patterns(clean_lyrics):
+    # Compile every clean lyric line once so that the matchers never have to rebuild pattern strings
+    return {
+        "lines": clean_lyrics,
+        # Matches the line at the end of the text
+        "end": [re.compile(line + "$") for line in clean_lyrics],
+        # The longest text each line can match, so a search for it only has to look that far back
+        "widths": [get_max_width(line) for line in clean_lyrics],
+        # Matches the line as the entire text
+        "full": [re.compile("^" + line + "$") for line in clean_lyrics],
+        # Patterns for runs of several consecutive lines, compiled the first time they are needed
+        "spans": {}
+    }
+
+
+def get_span_pattern(patterns, start, end):
+    # Get the pattern that matches lines start through end (inclusive) joined together with a space
+    if start == end:
+        return patterns["full"][end]
+
+    key = (start, end)
+    if key not in patterns["spans"]:
+        joined = " ".join(patterns["lines"][start:end + 1])
+        patterns["spans"][key] = re.compile("^" + joined + "$")
+    return patterns["spans"][key]
+
+
+def close_match_count(patterns, index, text):
+    # Count how many lines, going back from index, match the end of the text one after another.
+    # Instead of cutting each matched line off the text, only the end of what is left moves back.
+    # Searching with an end position behaves as if the text stopped there, so "$" matches at it.
     text = clean_up_text(text)
+    end_patterns = patterns["end"]
+    widths = patterns["widths"]
     result = 0
-    match = re.search(lyrics[index] + "$", text)
-    while index >= 0 and len(text) > 0 and match is not None:
-        # removed the matched area from the text
-        text = (text[:match.start()] + text[match.end():]).strip()
+    end = len(text)
+    while index >= 0 and end > 0:
+        # A match that ends at end can't start further back than the width of the line
+        start = 0 if widths[index] is None else max(0, end - widths[index])
+        match = end_patterns[index].search(text, start, end)
+        if match is None:
+            break
+        # remove the matched area and the whitespace before it
+        end = match.start()
+        while end > 0 and text[end - 1].isspace():
+            end -= 1
         result += 1
         index -= 1
-        match = re.search(lyrics[index] + "$", text)
 
     return result
 
 
-def close_match(song, index, text):
+def close_match(patterns, index, text):
     text = clean_up_text(text)
-    match_count = close_match_count(song, index, text)
+    match_count = close_match_count(patterns, index, text)
     if match_count > 0:
-        # join the matched lyrics together with a space
-        joined = " ".join(song[index - match_count + 1:index + 1])
-        # determine if the entire string matches this joined string
-        return re.match("^" + joined + "$", text) is not None
+        # determine if the entire string matches the matched lyrics joined together with a space
+        return get_span_pattern(patterns, index - match_count + 1, index).match(text) is not None
     else:
         return False
 
 
-def get_potential_lyric_indexes(song_dict, lyric):
+def get_required_words(line):
+    # Get the words that any match of a clean lyric line has to contain as whole words.
+    # Words inside a group or attached to regex syntax are optional or variable, so they are left out.
+    # Returns None if the line uses syntax that makes this impossible to tell.
+    if re.search(r'[\[\\^$]| [?*+{]', line):
+        return None
+
+    result = []
+    depth = 0
+    for word in line.split(' '):
+        if depth == 0 and re.match(r'^[a-z0-9]+$', word):
+            result.append(word)
+        for char in word:
+            if char == '(':
+                depth += 1
+            elif char == ')':
+                depth -= 1
+            elif char == '|' and depth == 0:
+                # A top-level alternation means no word is required
+                return None
+    return result
+
+
+def index_song_lyrics(clean_lyrics):
+    # Build the index entries for a single song. Each line is listed under its longest required word.
+    # Lines without any required words can match anything, so they are always candidates.
+    result = {
+        "required": [],
+        "postings": {},
+        "always": []
+    }
+
+    for i in range(len(clean_lyrics)):
+        required = get_required_words(clean_lyrics[i])
+        result["required"].append(required)
+        if not required:
+            result["always"].append(i)
+        else:
+            key = max(required, key=len)
+            result["postings"].setdefault(key, []).append(i)
+
+    return result
+
+
+def build_match_index(song_dict):
+    # Merge the index of each song into one word -> [(song, index)] lookup table
+    result = {
+        "postings": {},
+        "always": [],
+        "order": {}
+    }
+
+    for song_name in song_dict:
+        result["order"][song_name] = len(result["order"])
+        song_index = song_dict[song_name]["match_index"]
+        for word in song_index["postings"]:
+            postings = result["postings"].setdefault(word, [])
+            for i in song_index["postings"][word]:
+                postings.append((song_name, i))
+        for i in song_index["always"]:
+            result["always"].append((song_name, i))
+
+    return result
+
+
+def get_lyric_candidates(song_dict, match_index, clean_lyric):
+    # Get every (song, index) pair that could possibly match the text, in the same order as a full scan
+    words = set(clean_lyric.split(' '))
+    result = list(match_index["always"])
+    for word in words:
+        if word in match_index["postings"]:
+            for song_name, i in match_index["postings"][word]:
+                if words.issuperset(song_dict[song_name]["match_index"]["required"][i]):
+                    result.append((song_name, i))
+
+    result.sort(key=lambda x: (match_index["order"][x[0]], x[1]))
+    return result
+
+
+def get_potential_lyric_indexes(song_dict, lyric, match_index=None):
     result = []
     clean_lyric = clean_up_text(lyric)
+    if match_index is None:
+        # No index available, so every line of every song is a candidate
+        candidates = []
+        for song_name in song_dict:
+            for i in range(len(song_dict[song_name]["patterns"]["lines"])):
+                candidates.append((song_name, i))
+    else:
+        candidates = get_lyric_candidates(song_dict, match_index, clean_lyric)
+
+    for song_name, i in candidates:
+        if close_match(song_dict[song_name]["patterns"], i, clean_lyric):
+            result.append({
+                "index": i,
+                "song": song_name,
+                "dict": song_dict[song_name]
+            })
+    return result
+
+
+def expand_regex(pattern, limit=64):
+    # Get every string a regex can match, or None if there are more than limit of them or it can't be worked out
+    def expand(items):
+        results = [""]
+        for op, av in items:
+            if op is sre_parse.LITERAL:
+                options = [chr(av)]
+            elif op is sre_parse.IN and all(item_op is sre_parse.LITERAL for item_op, item_av in av):
+                # Single characters in a branch, like (i|e), are parsed as a set
+                options = [chr(item_av) for item_op, item_av in av]
+            elif op is sre_parse.SUBPATTERN:
+                options = expand(av[-1])
+            elif op is sre_parse.BRANCH:
+                options = []
+                for branch in av[1]:
+                    branch_options = expand(branch)
+                    if branch_options is None:
+                        return None
+                    options += branch_options
+            elif op is sre_parse.MAX_REPEAT or op is sre_parse.MIN_REPEAT:
+                low, high, repeated = av
+                repeated_options = expand(repeated)
+                if repeated_options is None or high > 1:
+                    return None
+                options = ([""] if low == 0 else []) + repeated_options
+            else:
+                return None
+            if options is None:
+                return None
+            results = [result + option for result in results for option in options]
+            if len(results) > limit:
+                return None
+        return results
+
+    try:
+        results = expand(sre_parse.parse(pattern))
+    except re.error:
+        return None
+    if results is None:
+        return None
+    # Keep the first occurrence of each string
+    return list(dict.fromkeys(results))
+
+
+class Canonicalizer:
+    # Turns clean text into a sequence of canonical tokens, so that a comment and a lyric line that the regex
+    # matcher treats as the same word for word end up as the same sequence. Built from the word regexes:
+    # - Rules with a finite set of words, like "(about|abt)", map every word on either side to the first word
+    #   on the left. Phrases like "was not" become a single token.
+    # - Suffix rules, like "(\w+?)e?s = \3(e?s?)", strip any of the suffixes on either side.
+    # Folding both ways is more than the one way rules allow, e.g. "wes" folds to "we" although only plurals
+    # in the lyrics match singulars, so texts with the same tokens are only candidates for a match.
+    # The words of the rules are cleaned like the text is, e.g. "that will" becomes "that wil", so they still
+    # match once repeated letters are collapsed.
+
+    def __init__(self, word_regexes=None):
+        self.words = {}
+        self.phrases = {}
+        self.max_phrase_length = 1
+        self.suffixes = []
+        self.token_cache = {}
+        if not word_regexes:
+            return
+
+        # The suffixes are needed to fold the words of the other rules, so they are collected first
+        finite_rules = []
+        for word, replacement in word_regexes.items():
+            if word.startswith("(\\w+?)") and replacement.startswith("\\3"):
+                suffixes = (expand_regex(word[len("(\\w+?)"):]) or []) + (expand_regex(replacement[2:]) or [])
+                suffixes = {plain_normalizer.normalize(suffix) for suffix in suffixes}
+                suffixes = sorted({suffix for suffix in suffixes if suffix != ""}, key=len, reverse=True)
+                if suffixes:
+                    self.suffixes.append(suffixes)
+                continue
+
+            left = expand_regex(word)
+            right = expand_regex(replacement)
+            if left and right:
+                finite_rules.append((
+                    [plain_normalizer.normalize(text) for text in left],
+                    [plain_normalizer.normalize(text) for text in right]
+                ))
+
+        phrases = []
+        for left, right in finite_rules:
+            canonical = left[0].replace(" ", "")
+            for text in left + right:
+                tokens = text.split()
+                if len(tokens) == 1:
+                    self.words.setdefault(tokens[0], canonical)
+                elif len(tokens) > 1:
+                    phrases.append((tokens, canonical))
+
+        # The suffix rules also apply to the words of a phrase, e.g. "was not" matches "wa not",
+        # so phrases are looked up by their folded words
+        for tokens, canonical in phrases:
+            self.phrases.setdefault(tuple(self.canonical_token(token) for token in tokens), canonical)
+            self.max_phrase_length = max(self.max_phrase_length, len(tokens))
+
+    def strip_suffixes(self, token):
+        # Strip suffixes until none is left, e.g. "doees" and "does" both become "do"
+        stripped = True
+        while stripped:
+            stripped = False
+            for suffixes in self.suffixes:
+                for suffix in suffixes:
+                    if len(token) > len(suffix) and token.endswith(suffix):
+                        token = token[:-len(suffix)]
+                        stripped = True
+                        break
+        return token
+
+    def canonical_token(self, token):
+        # The suffix rules also apply to the words of the other rules, e.g. "sayes" matches "says"
+        if token not in self.token_cache:
+            if token in self.words:
+                result = self.words[token]
+            else:
+                result = self.strip_suffixes(token)
+                result = self.words.get(result, result)
+            self.token_cache[token] = result
+        return self.token_cache[token]
+
+    def canonicalize(self, clean_text):
+        # clean_text has been through clean_up_text without word regexes
+        tokens = [self.canonical_token(token) for token in clean_text.split()]
+        result = []
+        i = 0
+        while i < len(tokens):
+            for length in range(min(self.max_phrase_length, len(tokens) - i), 1, -1):
+                phrase = tuple(tokens[i:i + length])
+                if phrase in self.phrases:
+                    result.append(self.phrases[phrase])
+                    i += length
+                    break
+            else:
+                result.append(tokens[i])
+                i += 1
+        return " ".join(result)
+
+
+def build_hash_index(song_dict, canonicalizer):
+    # Map the canonical text of every lyric line to the (song, index) pairs of the lines with that text.
+    # Lines whose canonical text is empty are candidates for every comment.
+    lines = {}
+    always = []
+    order = {}
+    longest_line = 0
     for song_name in song_dict:
-        if type(song_dict) is list:
-            print(song_dict)
-        song = song_dict[song_name]["clean_lyrics"]
-        for i in range(len(song)):
-            if close_match(song, i, clean_lyric):
-                result.append({
-                    "index": i,
-                    "song": song_name,
-                    "dict": song_dict[song_name]
-                })
+        order[song_name] = len(order)
+        for i, line in enumerate(song_dict[song_name]["original_lyrics"]):
+            key = canonicalizer.canonicalize(plain_normalizer.normalize(line))
+            if key == "":
+                always.append((song_name, i))
+            else:
+                lines.setdefault(key, []).append((song_name, i))
+                longest_line = max(longest_line, len(key.split(" ")))
+    return {"canonicalizer": canonicalizer, "lines": lines, "always": always, "order": order,
+            "longest_line": longest_line}
+
+
+def get_hash_lyric_indexes(song_dict, hash_index, lyric):
+    # Same result format as get_potential_lyric_indexes. A comment that matches one or more lines ends with the
+    # last of them, so the lines are looked up by every ending of the comment up to the longest line,
+    # which works for runs of any number of lines. Only the lines found are checked with close_match,
+    # so nothing is matched that the regex matcher wouldn't match. A line is missed if a rule lets the comment
+    # differ from it in a way the Canonicalizer doesn't fold, which the "shadow" match mode reports.
+    clean_lyric = clean_up_text(lyric)
+    tokens = hash_index["canonicalizer"].canonicalize(clean_lyric).split(" ")
+    lines = hash_index["lines"]
+    candidates = list(hash_index["always"])
+    for length in range(1, min(len(tokens), hash_index["longest_line"]) + 1):
+        candidates += lines.get(" ".join(tokens[-length:]), [])
+    candidates.sort(key=lambda x: (hash_index["order"][x[0]], x[1]))
+
+    result = []
+    for song_name, i in candidates:
+        if close_match(song_dict[song_name]["patterns"], i, clean_lyric):
+            result.append({
+                "index": i,
+                "song": song_name,
+                "dict": song_dict[song_name]
+            })
     return result
 
 
-def get_lyric_extent(song, song_name, comment, index, username):
+corpus_file = 'lyrics/corpus.pickle'
+# Increase this whenever the layout of the corpus changes so that old corpus files are rebuilt
+corpus_version = 1
+
+
+def get_file_hash(file_name, previous_files=None):
+    # Hash the contents of a file. If the size and modification time haven't changed since the previous
+    # corpus was built, the previous hash is reused instead of reading the file again.
+    stat = os.stat(file_name)
+    if previous_files and file_name in previous_files:
+        previous = previous_files[file_name]
+        if previous["size"] == stat.st_size and previous["mtime"] == stat.st_mtime_ns:
+            return previous
+
+    with open(file_name, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": digest}
+
+
+def build_song_entry(song, normalizer):
+    # Prepare everything about a song that only depends on its original lyrics and the word regexes
+    original_lyrics = get_original_lyrics(song)
+    clean_lyrics = generate_clean_lyrics(song, original_lyrics, normalizer)
+
+    ignore_indexes = []
+    for i in range(len(original_lyrics)):
+        if original_lyrics[i][0] == "^":
+            ignore_indexes.append(i)
+            original_lyrics[i] = original_lyrics[i][1:].strip()
+
+    continue_indexes = []
+    for i in range(len(original_lyrics)):
+        if original_lyrics[i].endswith("->"):
+            continue_indexes.append(i)
+            original_lyrics[i] = original_lyrics[i][:-2].strip()
+
+    return {
+        "original_lyrics": original_lyrics,
+        "clean_lyrics": clean_lyrics,
+        "match_index": index_song_lyrics(clean_lyrics),
+        "ignore_indexes": ignore_indexes,
+        "continue_indexes": continue_indexes
+    }
+
+
+def read_corpus():
+    # Read the whole corpus file at once. Returns None if it is missing or from an older version.
+    if not os.path.exists(corpus_file):
+        return None
+
+    try:
+        with open(corpus_file, 'rb') as f:
+            corpus = pickle.loads(f.read())
+    except Exception:
+        print("Could not read the corpus file. It will be rebuilt.")
+        return None
+
+    if not isinstance(corpus, dict) or corpus.get("version") != corpus_version:
+        return None
+    return corpus
+
+
+def write_corpus(corpus):
+    # Write to a temporary file first so that an interrupted write never leaves a broken corpus behind
+    temp_file_name = corpus_file + '.tmp'
+    with open(temp_file_name, 'wb') as f:
+        pickle.dump(corpus, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_file_name, corpus_file)
+
+
+def load_corpus(song_list, match_mode="regex"):
+    # Load the prepared corpus, rebuilding only the songs whose original lyrics or word regexes changed.
+    # The result holds a song_dict ready for matching and the merged match index.
+    # The hash index is only built for the match modes that use it (see setup), and is None otherwise.
+    previous = read_corpus()
+    previous_files = previous["files"] if previous else {}
+    previous_songs = previous["songs"] if previous else {}
+
+    # make sure the word regex file exists
+    word_regexes = get_word_regexes()
+    normalizer = None
+
+    files = {}
+    for file_name in ['songs.txt', 'word_regexes.txt']:
+        files[file_name] = get_file_hash(file_name, previous_files)
+
+    songs = {}
+    changed = previous is None or previous["song_list"] != song_list
+    for song in song_list:
+        file_name = 'lyrics/original/' + song + '.txt'
+        if not os.path.exists(file_name):
+            # get_original_lyrics raises the usual error for missing lyrics
+            get_original_lyrics(song)
+        files[file_name] = get_file_hash(file_name, previous_files)
+
+        key = hashlib.sha256(
+            (files['word_regexes.txt']["hash"] + files[file_name]["hash"]).encode("utf-8")
+        ).hexdigest()
+        if song in previous_songs and previous_songs[song]["key"] == key:
+            songs[song] = previous_songs[song]
+        else:
+            if normalizer is None:
+                normalizer = Normalizer(word_regexes)
+            print("Preparing lyrics for '" + song + "'")
+            songs[song] = build_song_entry(song, normalizer)
+            songs[song]["key"] = key
+            changed = True
+
+    if changed:
+        song_dict = {song: songs[song] for song in song_list}
+        corpus = {
+            "version": corpus_version,
+            "song_list": song_list,
+            "files": files,
+            "songs": songs,
+            "match_index": build_match_index(song_dict)
+        }
+        print("Writing corpus file")
+        write_corpus(corpus)
+    elif files != previous_files:
+        # Only the recorded modification times changed, so the prepared data is still valid
+        corpus = previous
+        corpus["files"] = files
+        write_corpus(corpus)
+    else:
+        corpus = previous
+
+    song_dict = {}
+    for song in song_list:
+        song_dict[song] = dict(corpus["songs"][song])
+        song_dict[song]["patterns"] = compile_lyric_patterns(song_dict[song]["clean_lyrics"])
+
+    # Changes whenever any song or the word regexes change
+    corpus_key = hashlib.sha256(
+        "\n".join([str(corpus_version)] + [song + " " + corpus["songs"][song]["key"] for song in song_list]).encode("utf-8")
+    ).hexdigest()
+
+    return {
+        "songs": song_dict,
+        "match_index": corpus["match_index"],
+        "hash_index": build_hash_index(song_dict, Canonicalizer(word_regexes)) if match_mode != "regex" else None,
+        "key": corpus_key
+    }
+
+
+@metrics.api_caller("get_lyric_extent")
+def get_lyric_extent(patterns, song_name, comment, index, username):
+    # Walk up the chain through the ancestor cache so that each comment is only fetched once per run.
+    # Replies of this bot are recognised through the reply index, so the walk ends there without fetching them.
     current_comment = comment
     current_index = index
     current_extent = 0
     while current_index >= 0:
-        if current_comment.author.name == username:
-            # find the current position using regex "Current position: <current_position>"
-            current_position = re.search(r'Current position: (\d+)', current_comment.body)
-            if current_position is None:
+        if username == reddit_tools.username:
+            bot_reply = reddit_tools.get_bot_reply(current_comment)
+        elif reddit_tools.get_comment_info(current_comment).author == username:
+            info = reddit_tools.get_comment_info(current_comment)
+            bot_reply = reddit_tools.parse_bot_reply(info.id, info.parent_id, info.body)
+        else:
+            bot_reply = None
+
+        if bot_reply is not None:
+            if bot_reply.position is None:
                 print(
                     "Found one of this bot's comments, but it doesn't have a current position. This marks the end of the previous chain.")
                 return current_extent - 1
             else:
-                current_position = int(current_position.group(1))
-                if get_compatibility_mode(current_comment) > 1:
+                current_position = bot_reply.position
+                if bot_reply.compatibility_mode > 1:
                     current_position -= 1
 
                 if current_position == current_index:
-                    # find the internal song name using regex "Internal song name: <internal_song_name>"
-                    internal_song_name = re.search(r'Internal song name: (\w+)', current_comment.body)
-                    if internal_song_name is None:
+                    if bot_reply.song is None:
                         print(
                             "Found one of this bot's comments, but it doesn't have an internal song name. This marks the end of the previous chain.")
                         return current_extent
-                    elif internal_song_name.group(1) == song_name:
+                    elif bot_reply.song == song_name:
                         # As we have guaranteed that this comment is the one that matches the chain, we return infinity so that it will be recognized as the highest extent
                         return math.inf
                     else:
@@ -294,24 +827,28 @@ def get_lyric_extent(song, song_name, comment, index, username):
                         "Found one of this bot's comments, but the position was not the same as was expected. This marks the end of the previous chain.")
                     return current_extent
 
-        count = close_match_count(song, current_index, current_comment.body)
-        if close_match(song, current_index, current_comment.body):
+        current_comment = reddit_tools.get_comment_info(current_comment)
+        body = get_clean_body(current_comment)
+        count = close_match_count(patterns, current_index, body)
+        if close_match(patterns, current_index, body):
             current_extent += count
         else:
             return current_extent
 
-        if reddit_tools.is_root_comment(current_comment):
+        if current_comment.parent_id == current_comment.link_id:
             break
+        # The parent is only fetched if it isn't one of this bot's replies
+        current_comment = current_comment.parent_id
 
-        current_comment = current_comment.parent()
         current_index -= count
 
     return current_extent
 
 
-def get_lyric_index(song_dict, comment, username, potential_indexes=None):
+@metrics.api_caller("get_lyric_index")
+def get_lyric_index(song_dict, comment, username, potential_indexes=None, match_index=None):
     if not potential_indexes:
-        potential_indexes = get_potential_lyric_indexes(song_dict, comment.body)
+        potential_indexes = get_potential_lyric_indexes(song_dict, get_clean_body(comment), match_index)
 
     if len(potential_indexes) == 0:
         return None
@@ -324,9 +861,9 @@ def get_lyric_index(song_dict, comment, username, potential_indexes=None):
         for pair in potential_indexes:
             index = pair["index"]
             song_name = pair["song"]
-            song = pair["dict"]["clean_lyrics"]
+            patterns = pair["dict"]["patterns"]
 
-            extent = get_lyric_extent(song, song_name, comment, index, username)
+            extent = get_lyric_extent(patterns, song_name, comment, index, username)
             if extent is not None:
                 extent_array.append({"extent": extent, "index": index, "song": song_name})
                 if extent > max_extent:
@@ -345,19 +882,18 @@ def get_lyric_index(song_dict, comment, username, potential_indexes=None):
                 }
 
 
-def is_bottom_chain(song_dict, song_name, comment, username=reddit_tools.username):
-    comment.refresh()
-    if comment.replies is None:
-        return True
-    else:
-        for reply in comment.replies:
-            if reply.author.name == username:
+@metrics.api_caller("is_bottom_chain")
+def is_bottom_chain(song_dict, song_name, comment, username=reddit_tools.username, match_index=None):
+    if username == reddit_tools.username and reddit_tools.has_bot_reply(comment):
+        return False
+    for reply in reddit_tools.get_replies(comment):
+        if reply.author == username:
+            return False
+        potential_indexes = get_potential_lyric_indexes(song_dict, get_clean_body(reply), match_index)
+        for i in potential_indexes:
+            if i["song"] == song_name:
                 return False
-            potential_indexes = get_potential_lyric_indexes(song_dict, clean_up_text(reply.body))
-            for i in potential_indexes:
-                if i["song"] == song_name:
-                    return False
-        return True
+    return True
 
 
 default_reply = strip_lines(
@@ -423,6 +959,13 @@ ignore_post_reply = strip_lines(
 )
 help_link = "https://www.reddit.com/r/Encanto_LyricBot/comments/tesdvp/encanto_lyric_bot_faq/"
 
+opt_in_text = "!optin"
+opt_out_text = "!optout"
+ignore_submission_text = "!ignorepost"
+
+optout_message_link = f"https://www.reddit.com/message/compose?to=%2Fu%2F{reddit_tools.username}&subject={opt_out_text}&message=Send%20This%20Message%20To%20Opt%20Out"
+optin_message_link = f"https://www.reddit.com/message/compose?to=%2Fu%2F{reddit_tools.username}&subject={opt_in_text}&message=Send%20This%20Message%20To%20Opt%20In"
+
 
 def format_reply(next_line, current_position, internal_song_name, friendly_song_name, help_link, owner, username,
                  compatibility_mode, song_url, optout_message_link, optin_message_link, reply_base=default_reply):
@@ -443,12 +986,376 @@ def format_reply(next_line, current_position, internal_song_name, friendly_song_
     return reply
 
 
-def main(args=None):
+@metrics.api_caller("inbox")
+def process_inbox(user_blacklist, submission_ignore_list):
+    # Handle opt-ins, opt-outs and requests to ignore a post, updating the lists in place.
+    # The lists save each change as it is made.
+    inbox = reddit_tools.get_inbox(("comment", "message"))
+
+    # Inbox comments don't say which submission they are in, so look that up for every request to ignore
+    # a post at once
+    with reddit_tools.priority(reddit_tools.reply_priority):
+        reddit_tools.hydrate_comments([comment.fullname for comment in inbox["comment"]
+                                       if comment.author and comment.body.lower() == ignore_submission_text.lower()])
+
+    # search for comments
+    for comment in inbox["comment"]:
+        if comment.author:
+            body = comment.body
+            user = comment.author.name
+            if body.lower() == opt_out_text.lower() and user not in user_blacklist:
+                user_blacklist.add(user)
+                print("User " + user + " has opted out of notifications.")
+                reddit_tools.reply_to_comment(comment, "You have opted out of this bot's services. Have a nice day!")
+            elif body.lower() == opt_in_text.lower() and user in user_blacklist:
+                user_blacklist.remove(user)
+                print("User " + user + " has opted in to notifications.")
+                reddit_tools.reply_to_comment(comment,
+                                              "You have opted back in to this bot's services. Have a nice day!")
+
+            if body.lower() == ignore_submission_text.lower():
+                with reddit_tools.priority(reddit_tools.reply_priority):
+                    submission_id = reddit_tools.get_comment_info(comment).link_id
+                if submission_id in submission_ignore_list:
+                    continue
+                submission_ignore_list.add(submission_id)
+                print("Submission " + submission_id + " has been ignored.")
+                reddit_tools.reply_to_comment(comment, ignore_post_reply)
+
+    # search for messages
+    for message in inbox["message"]:
+        if message.author:
+            body = message.subject
+            user = message.author.name
+            if body.lower() == opt_out_text.lower() and user not in user_blacklist:
+                user_blacklist.add(user)
+                print("User " + user + " has opted out of notifications.")
+                reddit_tools.reply_to_message(message, "You have opted out of this bot's services. Have a nice day!")
+            elif body.lower() == opt_in_text.lower() and user in user_blacklist:
+                user_blacklist.remove(user)
+                print("User " + user + " has opted in to notifications.")
+                reddit_tools.reply_to_message(message,
+                                              "You have opted back in to this bot's services. Have a nice day!")
+
+
+def check_author(context, comment, state):
+    if not comment.author:
+        return f"Found comment '{comment.id}' that does not have an author. Skipping..."
+
+
+def check_start_time(context, comment, state):
+    # Don't handle the comment if it was made after process_start_time
+    process_start_time = context["process_start_time"]
+    if comment.created_utc > process_start_time:
+        return f"Found comment '{comment.id}' that was made after process start time ({process_start_time}). Skipping..."
+
+
+def check_user_blacklist(context, comment, state):
+    # Don't handle the comment if it is  made by a blacklisted user
+    if comment.author.name in context["user_blacklist"]:
+        return f"Found comment '{comment.id}' made by a blacklisted user (u/{comment.author}). Skipping..."
+
+
+def check_bot_author(context, comment, state):
+    # Don't handle the comment if it's made by the bot
+    if comment.author.name == reddit_tools.username:
+        return f"Found comment '{comment.id}' by this bot. Skipping..."
+
+
+def check_lyric_match(context, comment, state):
+    # Don't handle the comment if it doesn't look like any lyric. This is what most comments fail.
+    clean_body = get_clean_body(comment)
+    if context["match_mode"] == "hash":
+        if clean_body not in lyric_match_cache:
+            lyric_match_cache[clean_body] = get_hash_lyric_indexes(context["song_dict"], context["hash_index"], clean_body)
+    elif clean_body not in lyric_match_cache:
+        text_hash = get_text_hash(context, clean_body)
+        if text_hash in negative_matches:
+            lyric_match_cache[clean_body] = []
+        else:
+            lyric_match_cache[clean_body] = get_potential_lyric_indexes(context["song_dict"], clean_body,
+                                                                        context["match_index"])
+            if len(lyric_match_cache[clean_body]) == 0:
+                negative_matches.add(text_hash)
+        if len(lyric_match_cache[clean_body]) == 0:
+            used_negative_matches.add(text_hash)
+
+        if context["match_mode"] == "shadow":
+            report_hash_disagreement(context, comment, clean_body, lyric_match_cache[clean_body])
+
+    state["potential_indexes"] = lyric_match_cache[clean_body]
+    if len(state["potential_indexes"]) == 0:
+        return f"Comment '{comment.id}' doesn't seem to match any lyrics. Skipping..."
+
+
+def report_hash_disagreement(context, comment, clean_body, potential_indexes):
+    # Compare the hash index with the regex matcher, whose result is the one used
+    expected = [(index["song"], index["index"]) for index in potential_indexes]
+    found = [(index["song"], index["index"]) for index in
+             get_hash_lyric_indexes(context["song_dict"], context["hash_index"], clean_body)]
+    run_metrics = metrics.get_current()
+    if found == expected:
+        run_metrics.count("hash match agreed")
+    else:
+        run_metrics.count("hash match disagreed")
+        tqdm.write(f"Hash match disagrees with the regex match for comment '{comment.id}'. "
+                   f"Regex: {expected}, hash: {found}, text: {clean_body}")
+
+
+def check_ignored_submission(context, comment, state):
+    # Don't handle the comment if it belongs to a submission that has been ignored
+    if reddit_tools.get_comment_info(comment).link_id in context["submission_ignore_list"]:
+        return f"Found comment '{comment.id}' in an ignored submission. Skipping..."
+
+
+def check_replied_under(context, comment, state):
+    # Don't handle the comment if we have already replied to a comment further down the chain
+    if reddit_tools.did_reply_under(comment):
+        return f"Found comment '{comment.id}' already replied to. Skipping..."
+
+
+# How expensive each kind of check is, cheapest first:
+# string work on the comment itself, a lookup that only sometimes needs a request, and a request
+filter_costs = ["local", "cached", "network"]
+
+# The checks a comment has to pass before its chain is walked. Each returns the reason to skip the comment,
+# or None if it passes. Comments that fail a check with a "handled" outcome count as handled.
+# The checks run cheapest first, and in the listed order within the same cost.
+comment_filters = sorted([
+    {"name": "author", "cost": "local", "check": check_author, "outcome": None},
+    {"name": "start time", "cost": "local", "check": check_start_time, "outcome": None},
+    {"name": "user blacklist", "cost": "local", "check": check_user_blacklist, "outcome": None},
+    {"name": "bot author", "cost": "local", "check": check_bot_author, "outcome": None},
+    {"name": "lyric match", "cost": "local", "check": check_lyric_match, "outcome": "handled"},
+    {"name": "ignored submission", "cost": "cached", "check": check_ignored_submission, "outcome": None},
+    {"name": "replied under", "cost": "network", "check": check_replied_under, "outcome": None}
+], key=lambda comment_filter: filter_costs.index(comment_filter["cost"]))
+
+def new_filter_stats():
+    return {comment_filter["name"]: {"passed": 0, "rejected": 0, "seconds": 0.0} for comment_filter in comment_filters}
+
+
+def print_filter_stats(filter_stats):
+    for comment_filter in comment_filters:
+        stats = filter_stats[comment_filter["name"]]
+        print(f"Filter '{comment_filter['name']}' ({comment_filter['cost']}): {stats['passed']} passed, "
+              f"{stats['rejected']} rejected in {round(stats['seconds'], 3)} seconds")
+
+
+def filter_comment(context, comment, filter_stats=None):
+    # Run the comment through every check. Returns the state the checks left behind if it passes all of them,
+    # otherwise the outcome of the check it failed.
+    state = {}
+    for comment_filter in comment_filters:
+        start_time = time.time()
+        with metrics.caller(comment_filter["name"]):
+            reason = comment_filter["check"](context, comment, state)
+        if filter_stats is not None:
+            stats = filter_stats[comment_filter["name"]]
+            stats["seconds"] += time.time() - start_time
+            stats["rejected" if reason is not None else "passed"] += 1
+        if reason is not None:
+            tqdm.write(reason)
+            return False, comment_filter["outcome"]
+    return True, state
+
+
+def passes_local_filters(context, comment):
+    # Whether the comment passes the checks that don't need a request, without printing why it doesn't
+    state = {}
+    for comment_filter in comment_filters:
+        if comment_filter["cost"] == "local" and comment_filter["check"](context, comment, state) is not None:
+            return False
+    return True
+
+
+# How many comments up a chain hydrate_chains looks
+max_hydrate_depth = 20
+
+
+def hydrate_chains(context, comments):
+    # Load the ancestors of the comments that could be a match with bulk info requests, one level at a time,
+    # so that walking their chains doesn't fetch them one by one.
+    # Only ancestors that look like a lyric and aren't by this bot can continue a chain.
+    infos = [reddit_tools.get_comment_info(comment) for comment in comments if passes_local_filters(context, comment)]
+    for depth in range(max_hydrate_depth):
+        parent_ids = [info.parent_id for info in infos if info.parent_id != info.link_id]
+        if len(parent_ids) == 0:
+            return
+        reddit_tools.hydrate_comments(parent_ids)
+        infos = []
+        for parent_id in dict.fromkeys(parent_ids):
+            info = reddit_tools.ancestor_cache.get(parent_id)
+            if info is not None and info.author != reddit_tools.username and \
+                    check_lyric_match(context, info, {}) is None:
+                infos.append(info)
+
+
+def hydrate_in_batches(context, comments, batch_size=reddit_tools.info_batch_size):
+    # Give the comments back as they are, after hydrating the chains of each batch of them
+    batch = []
+    for comment in comments:
+        batch.append(comment)
+        if len(batch) == batch_size:
+            hydrate_chains(context, batch)
+            yield from batch
+            batch = []
+    if len(batch) > 0:
+        hydrate_chains(context, batch)
+        yield from batch
+
+
+def handle_comment(context, comment, compatibility_mode, filter_stats=None):
+    # Decide whether to reply to a single comment and reply if so.
+    # Returns None if the comment was skipped, "replied" if this bot replied to it and "handled" otherwise.
+    # The pass and reject counts and the time of each check are added to filter_stats if it is given.
+    song_dict = context["song_dict"]
+    match_index = context["match_index"]
+    song_friendly_names = context["songs"]["dict"]
+    song_urls = context["songs"]["urls"]
+
+    passed, result = filter_comment(context, comment, filter_stats)
+    if not passed:
+        return result
+    potential_indexes = result["potential_indexes"]
+
+    tqdm.write("Found comment '" + comment.id + "' by '" + comment.author.name + "' that could be a match.")
+    tqdm.write("Formatted Text: " + get_clean_body(comment))
+    potential_indexes_str = []
+    for index in potential_indexes:
+        potential_indexes_str.append({})
+        potential_indexes_str[-1]["index"] = index["index"]
+        potential_indexes_str[-1]["song"] = index["song"]
+    tqdm.write("Potential indexes: " + str(potential_indexes_str))
+
+    # Walking the chain of a comment that matches is more important than scanning more comments
+    with reddit_tools.priority(reddit_tools.verify_priority):
+        lyric_index = get_lyric_index(song_dict, comment, reddit_tools.username,
+                                      potential_indexes=potential_indexes, match_index=match_index)
+    if lyric_index is None:
+        tqdm.write(f"No match found. Skipping...")
+        return "handled"
+
+    current_position = lyric_index["index"]
+    song_name = lyric_index["song"]
+    song_url = song_urls[song_name]
+    original_lyrics = song_dict[song_name]["original_lyrics"]
+    clean_lyrics = song_dict[song_name]["clean_lyrics"]
+    ignore_indexes = song_dict[song_name]["ignore_indexes"]
+    continue_indexes = song_dict[song_name]["continue_indexes"]
+    patterns = song_dict[song_name]["patterns"]
+
+    with reddit_tools.priority(reddit_tools.verify_priority):
+        bottom_chain = is_bottom_chain(song_dict, song_name, comment, match_index=match_index)
+    if bottom_chain:
+        # current_position += 1
+        tqdm.write(f"Match Position: {current_position}")
+        tqdm.write(f"Match Song: {song_name}")
+        with reddit_tools.priority(reddit_tools.verify_priority):
+            extent = get_lyric_extent(patterns, song_name, comment, current_position, reddit_tools.username)
+
+        if current_position + 1 != len(clean_lyrics) or extent > 1:
+            if current_position in ignore_indexes and extent <= 1:
+                tqdm.write("Found a match, but it's an ignored lyric and at the beginning of a chain.")
+                tqdm.write("We don't start chains with ignored lyrics. Skipping...")
+                return "handled"
+
+            if current_position == len(clean_lyrics) - 1:
+                tqdm.write(f"Found match at the end of the song.")
+                tqdm.write("replying to indicate this...")
+                reply = format_reply(original_lyrics[current_position], current_position, song_name,
+                                     song_friendly_names[song_name], help_link, reddit_tools.owner,
+                                     reddit_tools.username, compatibility_mode, song_url,
+                                     optout_message_link, optin_message_link, reply_base=end_reply)
+                reddit_tools.reply_to_comment(comment, reply)
+                return "handled"
+
+            next_position = current_position + 1
+            next_line = original_lyrics[next_position]
+            while next_position in continue_indexes and next_position < len(clean_lyrics) - 1:
+                next_position += 1
+                tqdm.write("Continuing to position " + str(next_position) + " as it's a continue index.")
+                next_line += " " + original_lyrics[next_position]
+
+            tqdm.write("Extent: " + str(extent))
+            tqdm.write("replying...")
+            reply = format_reply(next_line, next_position, song_name, song_friendly_names[song_name],
+                                 help_link, reddit_tools.owner, reddit_tools.username, compatibility_mode,
+                                 song_url, optout_message_link, optin_message_link)
+            my_reply = reddit_tools.reply_to_comment(comment, reply)
+            if (next_position) == len(clean_lyrics) - 1:
+                tqdm.write(f"Just replied with the last line of the song.")
+                tqdm.write("replying to indicate this...")
+                reply = format_reply(original_lyrics[current_position + 1], current_position + 1, song_name,
+                                     song_friendly_names[song_name], help_link, reddit_tools.owner,
+                                     reddit_tools.username, compatibility_mode, song_url,
+                                     optout_message_link, optin_message_link, reply_base=end_reply)
+                reddit_tools.reply_to_comment(my_reply, reply)
+            return "replied"
+        else:
+            tqdm.write(
+                    "Not replying because the next line is the last line of the song and there is no evidence of a preexisting chain.")
+
+        return "handled"
+
+    else:
+        tqdm.write(f"This comment is not at the bottom of the chain. Skipping...")
+        return "handled"
+
+
+def setup(process_start_time=None, match_mode="regex"):
+    # Everything that only has to happen once per launch, however many subreddits are scanned afterwards.
+    # Returns the context that main() uses to scan each subreddit.
+    # process_start_time is read from "start_time.txt" unless it is given.
+    # match_mode decides how comments are matched to lyric lines: "regex" searches with the clean lyrics,
+    # "hash" looks up the canonical tokens in the hash index, and "shadow" uses the regex result but
+    # reports every comment where the hash index disagrees.
+    clear_run_caches()
+
     songs = get_songs()
-    song_list = songs["list"]
-    song_friendly_names = songs["dict"]
-    song_urls = songs["urls"]
 
+    # get the start time from "start_time.txt"
+    if process_start_time is None:
+        process_start_time = float(get_file_contents("start_time.txt")[0])
+
+    print("Loading lyrics corpus")
+    with metrics.stage("load corpus"):
+        corpus = load_corpus(songs["list"], match_mode)
+
+    negative_matches.clear()
+    negative_matches.update(comment_store.get_negative_matches())
+
+    print("Getting user blacklist")
+    user_blacklist = get_user_blacklist()
+    submission_ignore_list = get_submission_ignore_list()
+
+    print("Indexing this bot's recent replies")
+    try:
+        with metrics.stage("backfill replies"):
+            print(f"Added {reddit_tools.backfill_bot_replies()} replies to the index")
+    except reddit_tools.BudgetExhausted as e:
+        # Replies that aren't in the index yet are still recognised by their bodies
+        print(f"Stopped indexing replies early: {e}")
+
+    print("checking for user blacklist additions and submissions to ignore")
+    with metrics.stage("inbox"):
+        process_inbox(user_blacklist, submission_ignore_list)
+
+    return {
+        "songs": songs,
+        "song_dict": corpus["songs"],
+        "match_index": corpus["match_index"],
+        "corpus_key": corpus["key"],
+        "hash_index": corpus["hash_index"],
+        "match_mode": match_mode,
+        "user_blacklist": user_blacklist,
+        "submission_ignore_list": submission_ignore_list,
+        "process_start_time": process_start_time
+    }
+
+
+def main(args=None, context=None, comments=None):
+    # comments can be given to scan comments that were already fetched, e.g. from a combined listing
     if not args:
         args = tools.get_args(
             [
@@ -502,294 +1409,172 @@ def main(args=None):
                         'cancel': 'default'
                     },
                     'default': False,
+                },
+
+                {
+                    'name': 'prefetch threads',
+                    'target_type': bool,
+                    'input_args': {
+                        'invalid_message': 'Prefetch threads must be a boolean.',
+                        'cancel': 'default'
+                    },
+                    'default': False,
+                },
+
+                {
+                    'name': 'request budget',
+                    'target_type': int,
+                    'input_args': {
+                        'invalid_message': 'Request budget must be a positive integer, or 0 for no budget.',
+                        'cancel': 'default'
+                    },
+                    'condition': lambda x: x >= 0,
+                    'default': 0,
                 }
             ], False)
 
-    # get the start time from "start_time.txt"
-    process_start_time = float(get_file_contents("start_time.txt")[0])
-
     subreddit = reddit_tools.reddit.subreddit(args['subreddit']) if args['subreddit'] != 'default' else reddit_tools.test_subreddit
     comment_limit = args['comment limit'] if args['comment limit'] != 'default' else 1000
     max_age_hours = args['max age (hours)'] if args['max age (hours)'] != 'default' else 24.0
     compatibility_mode = args['compatibility mode'] if args['compatibility mode'] != 'default' else 1
     use_progress_bar = args['use progress bar'] if args['use progress bar'] != 'default' else False
+    prefetch_threads = args['prefetch threads'] if args['prefetch threads'] != 'default' else False
+    request_budget = args['request budget'] if args['request budget'] != 'default' else 0
 
     print("Specified subreddit: " + args['subreddit'])
     print("Specified Comment limit: " + str(comment_limit))
     print("Specified Max age: " + str(max_age_hours))
     print("Specified Compatibility mode: " + str(compatibility_mode))
     print("Specified Use progress bar: " + str(use_progress_bar))
+    print("Specified Prefetch threads: " + str(prefetch_threads))
+    print("Specified Request budget: " + str(request_budget))
 
-    print("Getting word regexes")
-    word_regexes = get_word_regexes()
+    # Everything this thread records from now on belongs to this subreddit.
+    # It is written to metrics/<subreddit>.json and metrics/<subreddit>.prom when the run ends.
+    run_metrics = metrics.start_run(str(subreddit))
 
-    song_dict = {}
-    for song in song_list:
-        print("Getting original lyrics for '" + song + "'")
-        original_lyrics = get_original_lyrics(song)
-        print("Getting clean lyrics for '" + song + "'")
-        clean_lyrics = get_clean_lyrics(song, word_regexes)
-
-        ignore_indexes = []
-        for i in range(len(original_lyrics)):
-            if original_lyrics[i][0] == "^":
-                ignore_indexes.append(i)
-                original_lyrics[i] = original_lyrics[i][1:].strip()
-
-        continue_indexes = []
-        for i in range(len(original_lyrics)):
-            if original_lyrics[i].endswith("->"):
-                continue_indexes.append(i)
-                original_lyrics[i] = original_lyrics[i][:-2].strip()
-
-        song_dict[song] = {
-            "original_lyrics": original_lyrics,
-            "clean_lyrics": clean_lyrics,
-            "ignore_indexes": ignore_indexes,
-            "continue_indexes": continue_indexes
-        }
+    # The metrics are written however the run ends, so the launcher and the files still get what was recorded
+    try:
+        # The launcher sets everything up once and passes the same context for every subreddit
+        if context is None:
+            context = setup()
 
-    """print("Getting subreddit moderators")
+        """print("Getting subreddit moderators")
 	mods = reddit_tools.get_mods(subreddit)"""
 
-    print("Getting user blacklist")
-    user_blacklist = get_user_blacklist()
-    submission_ignore_list = get_submission_ignore_list()
-
-    print("checking for user blacklist additions and submissions to ignore")
-    opt_in_text = "!optin"
-    opt_out_text = "!optout"
-    ignore_submission_text = "!ignorepost"
-
-    optout_message_link = f"https://www.reddit.com/message/compose?to=%2Fu%2F{reddit_tools.username}&subject={opt_out_text}&message=Send%20This%20Message%20To%20Opt%20Out"
-    optin_message_link = f"https://www.reddit.com/message/compose?to=%2Fu%2F{reddit_tools.username}&subject={opt_in_text}&message=Send%20This%20Message%20To%20Opt%20In"
-
-    # search for comments
-    for comment in reddit_tools.get_notifications("comment", True):
-        if comment.author:
-            body = comment.body
-            user = comment.author.name
-            if body.lower() == opt_out_text.lower() and user not in user_blacklist:
-                user_blacklist.append(user)
-                print("User " + user + " has opted out of notifications.")
-                reddit_tools.reply_to_comment(comment, "You have opted out of this bot's services. Have a nice day!")
-            elif body.lower() == opt_in_text.lower() and user in user_blacklist:
-                user_blacklist.remove(user)
-                print("User " + user + " has opted in to notifications.")
-                reddit_tools.reply_to_comment(comment,
-                                              "You have opted back in to this bot's services. Have a nice day!")
-
-            if body.lower() == ignore_submission_text.lower():
-                comment.refresh()
-                if comment.link_id in submission_ignore_list:
-                    continue
-                submission_id = comment.link_id
-                submission_ignore_list.append(submission_id)
-                print("Submission " + submission_id + " has been ignored.")
-                reddit_tools.reply_to_comment(comment, ignore_post_reply)
-
-    # search for messages
-    for message in reddit_tools.get_notifications("message", True):
-        if message.author:
-            body = message.subject
-            user = message.author.name
-            if body.lower() == opt_out_text.lower() and user not in user_blacklist:
-                user_blacklist.append(user)
-                print("User " + user + " has opted out of notifications.")
-                reddit_tools.reply_to_message(message, "You have opted out of this bot's services. Have a nice day!")
-            elif body.lower() == opt_in_text.lower() and user in user_blacklist:
-                user_blacklist.remove(user)
-                print("User " + user + " has opted in to notifications.")
-                reddit_tools.reply_to_message(message,
-                                              "You have opted back in to this bot's services. Have a nice day!")
-
-    update_user_blacklist(user_blacklist)
-    update_submission_ignore_list(submission_ignore_list)
-
-    requests_used = reddit_tools.reddit.auth.limits['used']
-
-    # Get a list of comments in the subreddit. Time how long this takes.
-    print("Getting comments")
-    start_time = time.time()
-    comments = reddit_tools.get_comments(subreddit, comment_limit)
-    # sort comments by age (newest first)
-    comments = sorted(comments, key=lambda x: x.created_utc, reverse=True)
-    total_comments = len(comments)
-
-    if total_comments == 0:
-        print("No comments found.")
-        return
-
-    handled_comments = 0
-    replied_comments = 0
-    print(f"Got {total_comments} comments in {str(time.time() - start_time)} seconds")
-
-    print("Filtering out comments older than max age")
-    count = 0
-    for comment in comments.copy():
-        age = (time.time() - comment.created_utc) / 3600
-        if age > max_age_hours:
-            comments.remove(comment)
-            count += 1
-    print(f"Filtered {count} comments")
-
-    if len(comments) == 0:
-        print("All comments have been filtered.")
-        return
-
-    # Loop through the comments. Time how long this takes.
-    print("Handling remaining comments")
-    start_time = time.time()
-
-    if use_progress_bar:
-        comments = tqdm(comments, position=0, leave=False)
-    else:
-        comments = tqdm(comments, position=0, leave=False, disable=True)
-
-    for comment in comments:
-        if comment.author:
-            # Don't handle the comment if it was made after process_start_time
-            if comment.created_utc > process_start_time:
-                tqdm.write(
-                          f"Found comment '{comment.id}' that was made after process start time ({process_start_time}). Skipping...")
-                continue
-
-            """#Don't handle the comment if it is a root comment made by a moderator
-			if comment.author.name in mods and reddit_tools.is_root_comment(comment):
-				print(f"Found root comment '{comment.id}' made by a moderator. Skipping...")
-				continue"""
-
-            # Don't handle the comment if it is  made by a blacklisted user
-            if comment.author.name in user_blacklist:
-                tqdm.write(f"Found comment '{comment.id}' made by a blacklisted user (u/{comment.author}). Skipping...")
-                continue
-
-            # Don't handle the comment if it's made by the bot
-            if comment.author.name == reddit_tools.username:
-                tqdm.write(f"Found comment '{comment.id}' by this bot. Skipping...")
-                continue
-
-            # Don't handle the comment if we have already replied to a comment further down the chain
-            if reddit_tools.did_reply_comment(comment, require_root=False):
-                tqdm.write(f"Found comment '{comment.id}' already replied to. Skipping...")
-                continue
-
-            # Don't handle the comment if it belongs to a submission that has been ignored
-            if not hasattr(comment, "link_id"):
-                # refresh the comment to populate the link_id property
-                comment.refresh()
-            if comment.link_id in submission_ignore_list:
-                tqdm.write(f"Found comment '{comment.id}' in an ignored submission. Skipping...")
-                continue
 
-            # print(f"Found comment '{comment.id}' by '{comment.author.name}'. Body:")
-            formatted_body = clean_up_text(comment.body)
-            # print(f"\t{formatted_body}")
-
-            tqdm.write("Found comment '" + comment.id + "' by '" + comment.author.name + "' that could be a match.")
-            tqdm.write("Formatted Text: " + formatted_body)
-            potential_indexes = get_potential_lyric_indexes(song_dict, formatted_body)
-            potential_indexes_str = []
-            for index in potential_indexes:
-                potential_indexes_str.append({})
-                potential_indexes_str[-1]["index"] = index["index"]
-                potential_indexes_str[-1]["song"] = index["song"]
-            tqdm.write("Potential indexes: " + str(potential_indexes_str))
-
-            if len(potential_indexes) > 0:
-                lyric_index = get_lyric_index(song_dict, comment, reddit_tools.username,
-                                              potential_indexes=potential_indexes)
-                if lyric_index is None:
-                    tqdm.write(f"No match found. Skipping...")
-                    handled_comments += 1
-                    continue
+        # Count the requests made by this thread, as other subreddits may be running at the same time.
+        # Once the budget is used, only replies are still made.
+        reddit_tools.start_run(request_budget if request_budget > 0 else None)
 
-                current_position = lyric_index["index"]
-                song_name = lyric_index["song"]
-                song_url = song_urls[song_name]
-                original_lyrics = song_dict[song_name]["original_lyrics"]
-                clean_lyrics = song_dict[song_name]["clean_lyrics"]
-                ignore_indexes = song_dict[song_name]["ignore_indexes"]
-                continue_indexes = song_dict[song_name]["continue_indexes"]
-
-                if is_bottom_chain(song_dict, song_name, comment):
-                    # current_position += 1
-                    tqdm.write(f"Match Position: {current_position}")
-                    tqdm.write(f"Match Song: {song_name}")
-                    extent = get_lyric_extent(clean_lyrics, song_name, comment, current_position, reddit_tools.username)
-
-                    if current_position + 1 != len(clean_lyrics) or extent > 1:
-                        if current_position in ignore_indexes and extent <= 1:
-                            tqdm.write("Found a match, but it's an ignored lyric and at the beginning of a chain.")
-                            tqdm.write("We don't start chains with ignored lyrics. Skipping...")
-                            handled_comments += 1
-                            continue
-
-                        if current_position == len(clean_lyrics) - 1:
-                            tqdm.write(f"Found match at the end of the song.")
-                            tqdm.write("replying to indicate this...")
-                            reply = format_reply(original_lyrics[current_position], current_position, song_name,
-                                                 song_friendly_names[song_name], help_link, reddit_tools.owner,
-                                                 reddit_tools.username, compatibility_mode, song_url,
-                                                 optout_message_link, optin_message_link, reply_base=end_reply)
-                            reddit_tools.reply_to_comment(comment, reply)
-                            handled_comments += 1
-                            continue
-
-                        next_position = current_position + 1
-                        next_line = original_lyrics[next_position]
-                        while next_position in continue_indexes and next_position < len(clean_lyrics) - 1:
-                            next_position += 1
-                            tqdm.write("Continuing to position " + str(next_position) + " as it's a continue index.")
-                            next_line += " " + original_lyrics[next_position]
-
-                        tqdm.write("Extent: " + str(extent))
-                        tqdm.write("replying...")
-                        reply = format_reply(next_line, next_position, song_name, song_friendly_names[song_name],
-                                             help_link, reddit_tools.owner, reddit_tools.username, compatibility_mode,
-                                             song_url, optout_message_link, optin_message_link)
-                        my_reply = reddit_tools.reply_to_comment(comment, reply)
-                        if (next_position) == len(clean_lyrics) - 1:
-                            tqdm.write(f"Just replied with the last line of the song.")
-                            tqdm.write("replying to indicate this...")
-                            reply = format_reply(original_lyrics[current_position + 1], current_position + 1, song_name,
-                                                 song_friendly_names[song_name], help_link, reddit_tools.owner,
-                                                 reddit_tools.username, compatibility_mode, song_url,
-                                                 optout_message_link, optin_message_link, reply_base=end_reply)
-                            reddit_tools.reply_to_comment(my_reply, reply)
-                        replied_comments += 1
-                    else:
-                        tqdm.write(
-                                "Not replying because the next line is the last line of the song and there is no evidence of a preexisting chain.")
+        # Comments are handled newest first, as they are fetched. Paging stops at the first comment older than
+        # max age or older than the newest comment the last finished scan of this subreddit saw.
+        cursor_name = str(subreddit)
+        cursor = comment_store.get_cursor(cursor_name)
+        if comments is None:
+            print("Getting comments")
+            comments = reddit_tools.get_comments(subreddit, comment_limit, max_age_hours, cursor)
+        else:
+            print("Using comments from the combined listing")
+            # The comments were loaded by another thread, whose Reddit instance this thread must not use
+            comments = reddit_tools.take_recent(reddit_tools.adopt(comments), max_age_hours, cursor)
+
+        total_comments = 0
+        handled_comments = 0
+        replied_comments = 0
+        newest_comment_utc = None
+        finished = True
+        filter_stats = new_filter_stats()
+        run_metrics.filters = filter_stats
+
+        if prefetch_threads:
+            # Load the comment tree of every submission that has a comment that could be a match
+            # The comments are needed twice, so they have to be fetched first
+            start_time = time.time()
+            try:
+                with metrics.stage("fetch comments"):
+                    comments = list(comments)
+            except reddit_tools.BudgetExhausted as e:
+                print(f"Not scanning: {e}")
+                return
+            print(f"Got {len(comments)} comments in {str(time.time() - start_time)} seconds")
+
+            try:
+                link_ids = []
+                for comment in comments:
+                    link_id = reddit_tools.get_comment_info(comment).link_id
+                    if link_id not in link_ids and passes_local_filters(context, comment):
+                        link_ids.append(link_id)
+                print(f"Prefetching the comment trees of {len(link_ids)} submissions")
+                with metrics.stage("prefetch"):
+                    reddit_tools.prefetch_submissions(link_ids)
+            except reddit_tools.BudgetExhausted as e:
+                # The trees that weren't prefetched are loaded as they are needed, if there is budget left for them
+                print(f"Stopped prefetching early: {e}")
+        else:
+            # Without the comment trees, the chains of the comments that could be a match are loaded in bulk
+            comments = hydrate_in_batches(context, comments)
 
-                    handled_comments += 1
+        # Loop through the comments. Time how long this takes.
+        print("Handling remaining comments")
+        start_time = time.time()
 
-                else:
-                    tqdm.write(f"This comment is not at the bottom of the chain. Skipping...")
-                    handled_comments += 1
-                    continue
-            else:
-                tqdm.write(f"This comment doesn't seem to match any lyrics. Skipping...")
-                handled_comments += 1
+        if use_progress_bar:
+            comments = tqdm(comments, position=0, leave=False)
         else:
-            tqdm.write(f"Found comment '{comment.id}' that does not have an author. Skipping...")
-
-    comments.close()
-
-    limit_info = reddit_tools.reddit.auth.limits
-    print(f"limit info: {limit_info}")
-    seconds_until_reset = (limit_info['reset_timestamp'] - time.time())
-    # split into minutes and seconds
-    minutes = int(math.floor(seconds_until_reset / 60))
-    seconds = str(int(round(seconds_until_reset % 60)))
-    if len(seconds) == 1:
-        seconds = "0" + seconds
-    print(f"Approximate time until reset (upper bound): {minutes}:{seconds}")
-
-    ignored_comments = total_comments - handled_comments
-    print(
-        f"Handled {handled_comments} out of {total_comments} ({ignored_comments} ignored; {replied_comments} replied to; {(handled_comments / total_comments) * 100}% coverage) comments in {str(time.time() - start_time)} seconds")
-    print(f"Used a total of {limit_info['used'] - requests_used} requests in this instance of the script.")
+            comments = tqdm(comments, position=0, leave=False, disable=True)
+
+        try:
+            with metrics.stage("handle comments"):
+                for comment in comments:
+                    total_comments += 1
+                    if newest_comment_utc is None:
+                        newest_comment_utc = comment.created_utc
+                    result = handle_comment(context, comment, compatibility_mode, filter_stats)
+                    run_metrics.count_outcome(result if result is not None else "skipped")
+                    if result is not None:
+                        handled_comments += 1
+                    if result == "replied":
+                        replied_comments += 1
+        except reddit_tools.BudgetExhausted as e:
+            # Leave the remaining comments to the next run rather than delay replies elsewhere
+            tqdm.write(f"Stopping early: {e}")
+            finished = False
+
+        comments.close()
+
+        # The next scan only has to go back as far as this one if every comment was handled.
+        # Comments made after the process start time were skipped, so the next scan has to see them again.
+        if finished and newest_comment_utc is not None:
+            comment_store.set_cursor(cursor_name, min(newest_comment_utc, context["process_start_time"]))
+
+        save_negative_matches()
+
+        if total_comments == 0:
+            print("No new comments found.")
+            return
+
+        # Comments older than a week won't come up in a scan again
+        comment_store.prune(7 * 24 * 60 * 60)
+
+        limit_info = reddit_tools.get_limits()
+        print(f"limit info: {limit_info}")
+        if limit_info['reset_timestamp'] is not None:
+            seconds_until_reset = (limit_info['reset_timestamp'] - time.time())
+            # split into minutes and seconds
+            minutes = int(math.floor(seconds_until_reset / 60))
+            seconds = str(int(round(seconds_until_reset % 60)))
+            if len(seconds) == 1:
+                seconds = "0" + seconds
+            print(f"Approximate time until reset (upper bound): {minutes}:{seconds}")
+
+        ignored_comments = total_comments - handled_comments
+        print(
+            f"Handled {handled_comments} out of {total_comments} ({ignored_comments} ignored; {replied_comments} replied to; {(handled_comments / total_comments) * 100}% coverage) comments in {str(time.time() - start_time)} seconds")
+        print(f"Used a total of {reddit_tools.get_run_request_count()} requests in this instance of the script.")
+        print_filter_stats(filter_stats)
+    finally:
+        run_metrics.write()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,179 @@
+import os
+import json
+import time
+import threading
+import contextlib
+import functools
+
+# Counters and timers for a run: API requests by the function that made them, time per stage,
+# and comments per filter result and outcome. Each thread records into its own Metrics, so subreddits
+# running at the same time don't mix, and the launcher merges them into one total.
+
+metrics_directory = 'metrics'
+
+# The Metrics and caller of each thread
+current = threading.local()
+
+
+class Metrics:
+    def __init__(self, name):
+        self.name = name
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+        # Requests made, by caller
+        self.api_calls = {}
+        # Seconds spent and times entered, by stage
+        self.stages = {}
+        # Comments that passed and were rejected by each filter, and the seconds the filter took
+        self.filters = {}
+        # Comments by what happened to them: skipped, handled or replied
+        self.outcomes = {}
+        # Anything else worth counting, by name
+        self.counters = {}
+
+    def count_api_call(self, caller):
+        with self.lock:
+            self.api_calls[caller] = self.api_calls.get(caller, 0) + 1
+
+    def add_stage_time(self, stage, seconds):
+        with self.lock:
+            stats = self.stages.setdefault(stage, {"seconds": 0.0, "count": 0})
+            stats["seconds"] += seconds
+            stats["count"] += 1
+
+    def add_filter_stats(self, filter_stats):
+        with self.lock:
+            for name, stats in filter_stats.items():
+                totals = self.filters.setdefault(name, {"passed": 0, "rejected": 0, "seconds": 0.0})
+                for key in totals:
+                    totals[key] += stats[key]
+
+    def count_outcome(self, outcome):
+        with self.lock:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def merge(self, other):
+        # Add everything another run recorded to this one
+        data = other.to_dict()
+        with self.lock:
+            for caller, count in data["api_calls"].items():
+                self.api_calls[caller] = self.api_calls.get(caller, 0) + count
+            for stage, stats in data["stages"].items():
+                totals = self.stages.setdefault(stage, {"seconds": 0.0, "count": 0})
+                totals["seconds"] += stats["seconds"]
+                totals["count"] += stats["count"]
+            for outcome, count in data["outcomes"].items():
+                self.outcomes[outcome] = self.outcomes.get(outcome, 0) + count
+            for name, count in data["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + count
+        self.add_filter_stats(data["filters"])
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "name": self.name,
+                "start_time": self.start_time,
+                "seconds": time.time() - self.start_time,
+                "api_calls": dict(self.api_calls),
+                "stages": {stage: dict(stats) for stage, stats in self.stages.items()},
+                "filters": {name: dict(stats) for name, stats in self.filters.items()},
+                "outcomes": dict(self.outcomes),
+                "counters": dict(self.counters)
+            }
+
+    def to_prometheus(self):
+        data = self.to_dict()
+        run = data["name"].replace('\\', '\\\\').replace('"', '\\"')
+        lines = [
+            "# TYPE lyricbot_run_seconds gauge",
+            f'lyricbot_run_seconds{{run="{run}"}} {data["seconds"]}',
+            "# TYPE lyricbot_api_calls_total counter"
+        ]
+        for caller, count in sorted(data["api_calls"].items()):
+            lines.append(f'lyricbot_api_calls_total{{run="{run}",caller="{caller}"}} {count}')
+        lines.append("# TYPE lyricbot_stage_seconds_total counter")
+        for stage, stats in sorted(data["stages"].items()):
+            lines.append(f'lyricbot_stage_seconds_total{{run="{run}",stage="{stage}"}} {stats["seconds"]}')
+        lines.append("# TYPE lyricbot_filter_comments_total counter")
+        for name, stats in sorted(data["filters"].items()):
+            for result in ("passed", "rejected"):
+                lines.append(f'lyricbot_filter_comments_total{{run="{run}",filter="{name}",result="{result}"}} {stats[result]}')
+        lines.append("# TYPE lyricbot_filter_seconds_total counter")
+        for name, stats in sorted(data["filters"].items()):
+            lines.append(f'lyricbot_filter_seconds_total{{run="{run}",filter="{name}"}} {stats["seconds"]}')
+        lines.append("# TYPE lyricbot_comments_total counter")
+        for outcome, count in sorted(data["outcomes"].items()):
+            lines.append(f'lyricbot_comments_total{{run="{run}",outcome="{outcome}"}} {count}')
+        lines.append("# TYPE lyricbot_events_total counter")
+        for name, count in sorted(data["counters"].items()):
+            lines.append(f'lyricbot_events_total{{run="{run}",event="{name}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        # Write metrics/<name>.json and metrics/<name>.prom, replacing the files of the previous run
+        if not os.path.exists(metrics_directory):
+            os.makedirs(metrics_directory)
+        file_name = metrics_directory + '/' + self.name
+        with open(file_name + '.json.tmp', 'w', encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=4)
+        os.replace(file_name + '.json.tmp', file_name + '.json')
+        with open(file_name + '.prom.tmp', 'w', encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(file_name + '.prom.tmp', file_name + '.prom')
+
+
+def start_run(name):
+    # Record everything this thread does from now on into new Metrics
+    current.metrics = Metrics(name)
+    return current.metrics
+
+
+def get_current():
+    metrics = getattr(current, 'metrics', None)
+    if metrics is None:
+        metrics = start_run('process')
+    return metrics
+
+
+def get_caller():
+    return getattr(current, 'caller', 'other')
+
+
+@contextlib.contextmanager
+def caller(name):
+    # Count the requests of this thread as made by the given caller until the block ends
+    previous = get_caller()
+    current.caller = name
+    try:
+        yield
+    finally:
+        current.caller = previous
+
+
+def api_caller(name):
+    # Decorator that counts the requests made by a function as made by name
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with caller(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def stage(name):
+    # Add the time the block takes to the stage
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        get_current().add_stage_time(name, time.time() - start_time)
+
+
+def count_api_call():
+    get_current().count_api_call(get_caller())
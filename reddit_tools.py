@@ -1,26 +1,254 @@
+import re
 import sys
+import time
+import threading
+import atexit
+import contextlib
+import comment_store
+import metrics
 try:
 	import praw
+	import prawcore
 except:
 	print("praw not installed")
 	install_command = sys.executable + " -m pip install praw"
 	print("Install command: " + install_command)
 	sys.exit()
+import cassette
 
 version = '0.1'
 
 username = 'Encanto_LyricBot'
 owner = "00PT"
 test_subreddit = '00PTBotTest'
-reddit = praw.Reddit('bot1')
+
+# Priorities of the work a request is made for, most important first
+reply_priority = 0
+verify_priority = 1
+scan_priority = 2
+
+# Requests of each priority are refused once the remaining quota would drop below its reserve,
+# so that there are always requests left for the more important work
+priority_reserves = {
+	reply_priority: 0,
+	verify_priority: 10,
+	scan_priority: 50
+}
+
+class BudgetExhausted(Exception):
+	# Raised instead of making a request that the rate limit or the budget of the current run can't afford
+	pass
+
+# Length of Reddit's rate limit window, assumed until a response says when the current one resets
+default_window_seconds = 600
+
+class RateBudget:
+	# A token bucket shared by every thread that makes requests. Tokens are added at the rate that would
+	# spend the remaining quota evenly until it resets, so running several subreddits at once never goes
+	# over the quota. The quota is read from the rate limit headers of every response, whichever
+	# Reddit instance made the request, as it belongs to the account.
+	# When requests of different priorities are waiting, the next token goes to the most important one.
+	def __init__(self, burst=10):
+		self.burst = burst
+		self.tokens = 1.0
+		self.last_refill = time.time()
+		self.lock = threading.Lock()
+		self.waiting = {priority: 0 for priority in priority_reserves}
+		self.remaining = None
+		self.used = None
+		self.reset_timestamp = None
+
+	def update(self, headers):
+		# Read the quota from the headers of a response
+		if 'x-ratelimit-remaining' not in headers:
+			return
+		with self.lock:
+			self.remaining = float(headers['x-ratelimit-remaining'])
+			self.used = int(float(headers.get('x-ratelimit-used', 0)))
+			if 'x-ratelimit-reset' in headers:
+				self.reset_timestamp = time.time() + int(float(headers['x-ratelimit-reset']))
+
+	def get_limits(self):
+		with self.lock:
+			return {
+				'remaining': self.remaining,
+				'used': self.used,
+				'reset_timestamp': self.reset_timestamp
+			}
+
+	def get_rate(self):
+		# Requests per second we can afford, or None before the first response has told us the quota.
+		# Without a known reset time, the remaining quota is spread over a whole window.
+		if self.remaining is None:
+			return None
+		if self.reset_timestamp is None or self.reset_timestamp < time.time():
+			return self.remaining / default_window_seconds
+		return self.remaining / max(self.reset_timestamp - time.time(), 1)
+
+	def check(self, priority):
+		# Refuse work that isn't important enough for what is left of the quota or of the run budget
+		remaining = self.remaining
+		if remaining is not None and self.reset_timestamp is not None and self.reset_timestamp < time.time():
+			# The window has reset since the last response
+			remaining = None
+		if remaining is not None and remaining - 1 < priority_reserves[priority]:
+			raise BudgetExhausted(f"Only {int(remaining)} requests remain until the rate limit resets")
+
+		budget = getattr(thread_requests, 'budget', None)
+		if budget is not None and priority != reply_priority and get_run_request_count() >= budget:
+			raise BudgetExhausted(f"The budget of {budget} requests for this run has been used")
+
+	def acquire(self, priority=scan_priority):
+		with self.lock:
+			self.check(priority)
+			self.waiting[priority] += 1
+		try:
+			while True:
+				with self.lock:
+					rate = self.get_rate()
+					if rate is None:
+						return
+
+					now = time.time()
+					self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * rate)
+					self.last_refill = now
+					more_important_waiting = any(self.waiting[other] > 0 for other in self.waiting if other < priority)
+					if self.tokens >= 1 and not more_important_waiting:
+						self.tokens -= 1
+						return
+
+					if more_important_waiting:
+						wait_time = 0.05
+					else:
+						# Wait for the next token, checking again at least once a second in case the limits reset
+						wait_time = min((1 - self.tokens) / rate, 1) if rate > 0 else 1
+				time.sleep(wait_time)
+		finally:
+			with self.lock:
+				self.waiting[priority] -= 1
+
+rate_budget = RateBudget()
+# Number of requests made by each thread, and the priority and budget of the work it is doing
+thread_requests = threading.local()
+
+class BudgetedRequestor(prawcore.Requestor):
+	# Every request made through praw waits for the shared rate budget first
+	def request(self, *args, **kwargs):
+		rate_budget.acquire(get_priority())
+		thread_requests.count = get_thread_request_count() + 1
+		metrics.count_api_call()
+		response = super().request(*args, **kwargs)
+		rate_budget.update(response.headers)
+		return response
+
+def get_limits():
+	# The remaining quota, the requests used and when the window resets, as of the last response.
+	# Every value is None until the first response.
+	return rate_budget.get_limits()
+
+def get_thread_request_count():
+	return getattr(thread_requests, 'count', 0)
+
+def start_run(budget=None):
+	# Start counting the requests of a run in this thread. Once budget requests have been made,
+	# everything but replies raises BudgetExhausted. None means no budget.
+	thread_requests.budget = budget
+	thread_requests.run_start = get_thread_request_count()
+
+def get_run_request_count():
+	return get_thread_request_count() - getattr(thread_requests, 'run_start', 0)
+
+def get_priority():
+	return getattr(thread_requests, 'priority', scan_priority)
+
+@contextlib.contextmanager
+def priority(level):
+	# Make the requests of this thread with the given priority until the block ends
+	previous = get_priority()
+	thread_requests.priority = level
+	try:
+		yield
+	finally:
+		thread_requests.priority = previous
+
+# Record the traffic of this run or replay a recorded one instead, if the environment asks for it
+session = cassette.get_session()
+requestor_kwargs = {}
+if session is not None:
+	requestor_kwargs['session'] = session
+	if isinstance(session, cassette.RecordingSession):
+		atexit.register(session.save)
+
+class ThreadReddit:
+	# praw doesn't say a Reddit instance can be used by several threads at once, so every thread gets
+	# its own instance. They share the rate budget through BudgetedRequestor.
+	# Use this like a praw.Reddit, e.g. reddit.comment(id=...).
+	def __init__(self):
+		self.instances = threading.local()
+
+	def get_instance(self):
+		instance = getattr(self.instances, 'instance', None)
+		if instance is None:
+			instance = praw.Reddit('bot1', requestor_class=BudgetedRequestor, requestor_kwargs=requestor_kwargs)
+			self.instances.instance = instance
+		return instance
+
+	def __getattr__(self, name):
+		return getattr(self.get_instance(), name)
+
+reddit = ThreadReddit()
+
+def adopt(items):
+	# Make praw objects loaded by another thread make their requests through this thread's instance
+	instance = reddit.get_instance()
+	for item in items:
+		item._reddit = instance
+	return items
 
 def get_comment(comment_id):
 	comment = reddit.comment(id=comment_id)
 	return comment
 
-def get_comments(subreddit, limit=1000):
-	comments = list(subreddit.comments(limit=limit))
-	return comments
+def take_recent(comments, max_age_hours=None, after_utc=None):
+	# Yield comments from a newest first iterable until one is older than max_age_hours
+	# or older than after_utc, the newest comment seen by the last finished scan
+	comments = iter(comments)
+	while True:
+		# Only the paging is counted as listing comments, not what the caller does between comments
+		with metrics.caller("get_comments"):
+			comment = next(comments, None)
+		if comment is None:
+			return
+		if max_age_hours is not None and (time.time() - comment.created_utc) / 3600 > max_age_hours:
+			return
+		if after_utc is not None and comment.created_utc < after_utc:
+			return
+		yield comment
+
+def get_comments(subreddit, limit=1000, max_age_hours=None, after_utc=None):
+	# The listing is newest first, so paging stops at the first comment that is too old
+	return take_recent(subreddit.comments(limit=limit), max_age_hours, after_utc)
+
+def get_combined_comments(subreddit_names, limit=1000, max_age_hours=None, after_utc=None):
+	# Page through the combined listing of several subreddits ("a+b+c") once instead of once per subreddit.
+	# Returns the comments grouped by lowercase subreddit name, newest first, with at most limit comments per subreddit.
+	result = {}
+	for name in subreddit_names:
+		result[name.lower()] = []
+
+	combined = reddit.subreddit("+".join(subreddit_names))
+	for comment in get_comments(combined, limit * len(subreddit_names), max_age_hours, after_utc):
+		name = comment.subreddit.display_name.lower()
+		if name in result and len(result[name]) < limit:
+			result[name].append(comment)
+	return result
+
+def stream_combined_comments(subreddit_names):
+	# Follow new comments of several subreddits as they are made, oldest first.
+	# Yields None after every poll of the listing, so that the caller gets a chance to do other work.
+	# praw doesn't wait between polls when pause_after is set, so the caller has to wait before asking for more.
+	combined = reddit.subreddit("+".join(subreddit_names))
+	return combined.stream.comments(pause_after=-1)
 
 def get_submission(submission_id):
 	submission = reddit.submission(id=submission_id)
@@ -37,26 +265,254 @@ def get_mods(subreddit):
 		result.append(mod.name)
 	return result
 
+class CommentInfo:
+	# The fields of a comment that are needed to walk up a comment chain
+	def __init__(self, id, body, author, parent_id, link_id):
+		self.id = id
+		self.fullname = "t1_" + id
+		self.body = body
+		# The name of the author, or None if the comment was deleted
+		self.author = author
+		self.parent_id = parent_id
+		self.link_id = link_id
+
+# Comments seen while walking chains, by fullname. Cleared at the start of every run.
+ancestor_cache = {}
+# Known replies of comments as CommentInfo lists, by the fullname of the parent. Cleared at the start of every run.
+reply_cache = {}
+# Fullnames of the submissions whose whole comment tree has been loaded into the caches in this run
+prefetched_submissions = set()
+
+def clear_caches():
+	ancestor_cache.clear()
+	reply_cache.clear()
+	prefetched_submissions.clear()
+
+def cache_comment(comment):
+	# Make a CommentInfo of a praw Comment that has all of its fields, and cache it
+	info = CommentInfo(
+		comment.id,
+		comment.body,
+		comment.author.name if comment.author else None,
+		comment.parent_id,
+		comment.link_id
+	)
+	ancestor_cache[info.fullname] = info
+	return info
+
+# Most fullnames Reddit looks up in one info request
+info_batch_size = 100
+
+@metrics.api_caller("hydrate_comments")
+def hydrate_comments(fullnames):
+	# Cache the comments that aren't cached yet, looking up to 100 of them per request
+	# instead of fetching them one by one
+	missing = list(dict.fromkeys(
+		fullname for fullname in fullnames if fullname.startswith("t1_") and fullname not in ancestor_cache
+	))
+	for i in range(0, len(missing), info_batch_size):
+		for comment in reddit.info(fullnames=missing[i:i + info_batch_size]):
+			if isinstance(comment, praw.models.Comment):
+				cache_comment(comment)
+
+def get_comment_info(comment):
+	# comment can be a praw Comment, a CommentInfo or a comment fullname.
+	# Each comment is only fetched the first time it is needed in a run, unless hydrate_comments already did.
+	if isinstance(comment, CommentInfo):
+		return comment
+
+	if isinstance(comment, str):
+		fullname = comment
+		comment = None
+	elif comment.fullname in ancestor_cache:
+		return ancestor_cache[comment.fullname]
+	elif 'link_id' in vars(comment):
+		# Checking the attribute itself would make praw fetch the comment
+		return cache_comment(comment)
+	else:
+		fullname = comment.fullname
+
+	hydrate_comments([fullname])
+	if fullname in ancestor_cache:
+		return ancestor_cache[fullname]
+
+	# The info lookup didn't return it, so refresh the comment to populate the link_id property
+	if comment is None:
+		comment = reddit.comment(id=fullname.split("_", 1)[1])
+	comment.refresh()
+	return cache_comment(comment)
+
+def get_parent_info(comment):
+	# Returns None if the comment is a root comment
+	info = get_comment_info(comment)
+	if info.parent_id == info.link_id:
+		return None
+	return get_comment_info(info.parent_id)
+
+def get_replies(comment):
+	# Get the replies of a comment as CommentInfo records. They come from the caches if the comment's
+	# submission was prefetched or the replies were already looked up in this run, and from a refresh otherwise.
+	info = get_comment_info(comment)
+	if info.fullname in reply_cache:
+		return reply_cache[info.fullname]
+
+	if isinstance(comment, (CommentInfo, str)):
+		comment = reddit.comment(id=info.id)
+	comment.refresh()
+	replies = []
+	for reply in comment.replies:
+		if isinstance(reply, praw.models.Comment):
+			replies.append(get_comment_info(reply))
+	reply_cache[info.fullname] = replies
+	return replies
+
+@metrics.api_caller("prefetch_submissions")
+def prefetch_submissions(link_ids):
+	# Load the whole comment tree of each submission once, expanding all "more comments" stubs in bulk.
+	# Parent, reply and root questions about comments in these submissions are then answered from the caches.
+	for link_id in link_ids:
+		if link_id in prefetched_submissions:
+			continue
+
+		submission = get_submission(link_id.split("_", 1)[1])
+		submission.comments.replace_more(limit=None)
+		for comment in submission.comments.list():
+			info = cache_comment(comment)
+			reply_cache.setdefault(info.fullname, [])
+			if info.parent_id != info.link_id:
+				reply_cache.setdefault(info.parent_id, []).append(info)
+		prefetched_submissions.add(link_id)
+
+@metrics.api_caller("is_root_comment")
 def is_root_comment(comment):
-	if not hasattr(comment, 'link_id'):
-		comment.refresh()
-	if comment.parent_id == comment.link_id:
+	info = get_comment_info(comment)
+	if info.parent_id == info.link_id:
 		return True
 	else:
 		return False
 
-def did_reply_comment(comment, username=username, require_root=True):
-	comment.refresh()
-	replies = list(comment.replies)
+@metrics.api_caller("did_reply_comment")
+def did_reply_comment(comment, username=username, require_root=True, record=False, results=None):
+	# If record is True, the result for this comment and every reply walked through is saved in the comment store,
+	# all in one transaction once the walk is done. results collects them on the way.
+	# Only use it with this bot's username and require_root=False, as that is what the store keeps track of.
+	if record and results is None:
+		results = {}
+		replied = did_reply_comment(comment, username, require_root, record, results)
+		comment_store.set_replied_under_many(results.items())
+		return replied
+
+	replies = get_replies(comment)
 	for reply in replies:
 		if reply.author:
-			if reply.author.name == username:
-				return True
-			elif (not require_root) and did_reply_comment(reply, username, False):
+			if reply.author == username:
+				if record:
+					results[comment.id] = True
 				return True
+			elif not require_root:
+				replied = comment_store.get_replied_under(reply.id) if record else None
+				if replied is None:
+					replied = did_reply_comment(reply, username, False, record, results)
+				if replied:
+					if record:
+						results[comment.id] = True
+					return True
 
+	if record:
+		results[comment.id] = False
 	return False
 
+def did_reply_under(comment):
+	# Determine if this bot has replied anywhere under the comment. The comment store is checked first,
+	# so the reply tree is only walked for comments that have never been evaluated.
+	replied = comment_store.get_replied_under(comment.id)
+	if replied is None:
+		replied = did_reply_comment(comment, username, require_root=False, record=True)
+	return replied
+
+def mark_replied_under(comment):
+	# Record that this bot has replied under the comment and those of its ancestors that were loaded in this run.
+	# Nothing is fetched for this, as it happens with every reply at reply priority, e.g. to inbox comments.
+	# An ancestor that isn't marked has its reply tree walked if it is evaluated later, which finds the reply.
+	# An ancestor that is already marked has had its own ancestors marked too, so the walk stops there.
+	marked = [(comment.id, True)]
+	current = ancestor_cache.get(comment.fullname)
+	while current is not None and current.parent_id != current.link_id:
+		current = ancestor_cache.get(current.parent_id)
+		if current is None or comment_store.get_replied_under(current.id):
+			break
+		marked.append((current.id, True))
+	comment_store.set_replied_under_many(marked)
+
+class BotReply:
+	# The chain state this bot wrote into one of its replies.
+	# position is the "Current position" as written, which counts from 1 from compatibility mode 2 on.
+	# song and position are None if the reply doesn't have them, e.g. for replies to the inbox.
+	def __init__(self, id, parent_id, song, position, compatibility_mode):
+		self.id = id
+		self.parent_id = parent_id
+		self.song = song
+		self.position = position
+		self.compatibility_mode = compatibility_mode
+
+def parse_bot_reply(id, parent_id, body):
+	position = re.search(r'Current position: (\d+)', body)
+	song = re.search(r'Internal song name: (\w+)', body)
+	compatibility_mode = re.search(r'Compatibility mode: (\d+)', body)
+	return BotReply(
+		id,
+		parent_id,
+		song.group(1) if song is not None else None,
+		int(position.group(1)) if position is not None else None,
+		int(compatibility_mode.group(1)) if compatibility_mode is not None else 1
+	)
+
+def record_bot_replies(replies):
+	comment_store.save_bot_replies([
+		(reply.id, reply.parent_id, reply.song, reply.position, reply.compatibility_mode, created_utc)
+		for reply, created_utc in replies
+	])
+
+def get_bot_reply(comment):
+	# The chain state of a reply of this bot, or None if the comment isn't one. comment can be a praw Comment,
+	# a CommentInfo or a comment fullname. It is only fetched and read if the index doesn't know it.
+	id = comment.split("_", 1)[1] if isinstance(comment, str) else comment.id
+	row = comment_store.get_bot_reply(id)
+	if row is not None:
+		return BotReply(id, *row)
+	info = get_comment_info(comment)
+	if info.author != username:
+		return None
+	reply = parse_bot_reply(info.id, info.parent_id, info.body)
+	record_bot_replies([(reply, time.time())])
+	return reply
+
+def has_bot_reply(comment):
+	# Whether the index knows of a reply of this bot to the comment
+	return comment_store.has_bot_reply_under(comment if isinstance(comment, str) else comment.fullname)
+
+# Pages of 100 comments of this bot's history that backfill_bot_replies reads at most
+bot_reply_backfill_pages = 5
+
+@metrics.api_caller("backfill_replies")
+def backfill_bot_replies(pages=bot_reply_backfill_pages):
+	# Add the replies this bot made since the last backfill to the index, e.g. from before the index existed
+	# or from another copy of the bot. The newest reply read is kept as a cursor, so only new ones are read next time.
+	cursor_name = "u/" + username
+	cursor = comment_store.get_cursor(cursor_name)
+	replies = []
+	newest_utc = None
+	for comment in reddit.redditor(username).comments.new(limit=pages * 100):
+		if cursor is not None and comment.created_utc <= cursor:
+			break
+		if newest_utc is None:
+			newest_utc = comment.created_utc
+		replies.append((parse_bot_reply(comment.id, comment.parent_id, comment.body), comment.created_utc))
+	record_bot_replies(replies)
+	if newest_utc is not None:
+		comment_store.set_cursor(cursor_name, newest_utc)
+	return len(replies)
+
 def did_reply_submission(submission, username=username, require_root=True):
 	comments = list(submission.comments)
 	for comment in comments:
@@ -67,57 +523,87 @@ def did_reply_submission(submission, username=username, require_root=True):
 				return True
 	return False
 
+# praw's mark_read sends 25 fullnames per request, so each batch of this size is exactly one request
+mark_read_batch_size = 25
+
+notification_types = {
+	'comment': praw.models.Comment,
+	'submission': praw.models.Submission,
+	'message': praw.models.Message
+}
+
+@metrics.api_caller("inbox")
+def mark_notifications_read(notifications):
+	# One request per 25 notifications instead of one per notification
+	for i in range(0, len(notifications), mark_read_batch_size):
+		reddit.inbox.mark_read(notifications[i:i + mark_read_batch_size])
+
+@metrics.api_caller("inbox")
+def get_inbox(types=('comment', 'message'), unread=True, mark_read=True):
+	# Walk the inbox once and sort what is found by type.
+	# Returns a dict with a list for each of the given types. Only the returned notifications are marked read.
+	result = {}
+	for type in types:
+		if type not in notification_types:
+			raise Exception('Invalid notification type: ' + type)
+		result[type] = []
+
+	# The inbox holds opt-outs, which must be handled even when the quota is low
+	with priority(reply_priority):
+		notifications = reddit.inbox.unread(limit=None) if unread else reddit.inbox.all(limit=None)
+		for notification in notifications:
+			for type in types:
+				if isinstance(notification, notification_types[type]):
+					result[type].append(notification)
+					break
+
+		if mark_read:
+			mark_notifications_read([notification for type in types for notification in result[type]])
+	return result
+
 def get_notifications(type='comment', unread=False, mark_read=True):
-	notifications = []
-	if unread:
-		notifications = reddit.inbox.unread()
+	if type == 'mention':
+		result = list(reddit.inbox.mentions())
+	elif type == 'all':
+		result = list(reddit.inbox.unread(limit=None) if unread else reddit.inbox.all(limit=None))
 	else:
-		notifications = reddit.inbox.all()
-	
-	result = []
-	for notification in notifications:
-		if type == 'comment':
-			if isinstance(notification, praw.models.Comment):
-				result.append(notification)
-				if mark_read:
-					reddit.inbox.mark_read([notification])
-		elif type == 'submission':
-			if isinstance(notification, praw.models.Submission):
-				result.append(notification)
-				if mark_read:
-					reddit.inbox.mark_read([notification])
-		elif type == 'message':
-			if isinstance(notification, praw.models.Message):
-				result.append(notification)
-				if mark_read:
-					reddit.inbox.mark_read([notification])
-		elif type == 'all':
-			result.append(notification)
-			if mark_read:
-				reddit.inbox.mark_read([notification])
-		elif type == 'mention':
-			for mention in reddit.inbox.mentions():
-				result.append(mention)
-				if mark_read:
-					reddit.inbox.mark_read([mention])
-		else:
-			raise Exception('Invalid notification type: ' + type)
+		result = get_inbox((type,), unread, False)[type]
 
-	return list(result)
+	if mark_read:
+		mark_notifications_read(result)
+	return result
 
+@metrics.api_caller("replies")
 def reply_to_comment(comment, text):
-	return comment.reply(text)
+	# Everything that goes with a reply has to happen even when the quota is low
+	with priority(reply_priority):
+		reply = comment.reply(text)
+		if reply is not None:
+			mark_replied_under(comment)
+			record_bot_replies([(parse_bot_reply(reply.id, comment.fullname, text), time.time())])
+			# Keep the cached replies up to date so later checks in this run see the new reply
+			if comment.fullname in reply_cache:
+				info = ancestor_cache[comment.fullname]
+				reply_info = CommentInfo(reply.id, text, username, info.fullname, info.link_id)
+				ancestor_cache[reply_info.fullname] = reply_info
+				reply_cache[info.fullname].append(reply_info)
+				reply_cache[reply_info.fullname] = []
+	return reply
 
+@metrics.api_caller("replies")
 def reply_to_submission(submission, text):
-	return submission.reply(text)
+	with priority(reply_priority):
+		return submission.reply(text)
 
+@metrics.api_caller("replies")
 def reply_to_message(message, text):
-	return message.reply(text)
+	with priority(reply_priority):
+		return message.reply(text)
 
 def get_comment_level(comment):
 	level = 0
-	parent = comment
-	while not is_root_comment(parent):
+	parent = get_parent_info(comment)
+	while parent is not None:
 		level += 1
-		parent = parent.parent()
+		parent = get_parent_info(parent)
 	return level
\ No newline at end of file